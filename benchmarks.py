@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks del modulo funciones con volumenes de radar sinteticos.
+"""
+
+#-----------------------------------------------------------------
+# Genera volumenes sinteticos de tamaño similar a los RMA (sin conexion
+# a internet), los escribe como CF/Radial y mide latencia, throughput y
+# pico de memoria de los caminos de extraccion de funciones.py:
+#             1) get_nearest_gate_azimuth / get_nearest_gate_azimuth_batch
+#             2) radar_variable_lat_lon
+#             3) radar_variable_window_lat_lon
+#             4) radar_variable_window_lat_lon_list
+#             5) create_df_from_radar_windows_vars
+#             6) calculate_R_from_Z_R / calculate_R_from_Z_ZDR_R / rain_rate_volume /
+#                db_to_linear_lut / rain_rate_lut
+#             7) import funciones (tiempo y memoria de arranque)
+# Los resultados se informan en JSON.
+#
+# Uso:
+#     python benchmarks.py --stations 10,100,1000 --fields 1,3,6 --windows 1,3,5
+#                          --output resultados.json
+#
+# Control de regresion del arranque (sale con codigo 1 si se superan los limites):
+#     python benchmarks.py --check --max-import-seconds 0.25 --max-import-mb 15
+#-----------------------------------------------------------------
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import funciones
+
+
+# Campos sinteticos disponibles, en el orden en que se agregan al volumen
+FIELDS = ['DBZH', 'ZDR', 'RHOHV', 'KDP', 'PHIDP', 'VRAD', 'WRAD', 'TH']
+
+
+
+def make_synthetic_volume(path,
+                          n_sweeps=10,
+                          n_rays=360,
+                          n_gates=480,
+                          gate_spacing=250.,
+                          fields=FIELDS,
+                          seed=0,
+                          fecha='2021-01-01T12:00:00Z'):
+    """
+    Funcion para generar un volumen sintetico con la geometria del RMA1 y escribirlo
+    como CF/Radial. Los campos tienen valores aleatorios en rangos fisicos razonables
+    y ~5% de gates enmascarados.
+    Parameters:
+            path (str): Path del archivo a escribir.
+            n_sweeps (int): Cantidad de barridos. Default 10.
+            n_rays (int): Rayos por barrido. Default 360.
+            n_gates (int): Gates por rayo. Default 480.
+            gate_spacing (float): Separacion entre gates en metros. Default 250.
+            fields (list): Campos a generar (de FIELDS). Default FIELDS.
+            seed (int): Semilla del generador aleatorio. Default 0.
+            fecha (str): Fecha del volumen en formato ISO con Z. Default '2021-01-01T12:00:00Z'.
+
+    Returns:
+            radar (radar obj): objeto radar generado.
+    """
+    import pyart
+
+    rng = np.random.default_rng(seed)
+    radar = pyart.testing.make_empty_ppi_radar(n_gates, n_rays, n_sweeps)
+    radar.latitude['data'][:] = funciones.RADAR_SITES['RMA1'][0]
+    radar.longitude['data'][:] = funciones.RADAR_SITES['RMA1'][1]
+    radar.altitude['data'][:] = 484.
+    radar.range['data'] = (np.arange(n_gates)*gate_spacing + gate_spacing/2).astype(np.float32)
+    radar.azimuth['data'] = np.tile(np.arange(n_rays)*360./n_rays, n_sweeps).astype(np.float32)
+    radar.fixed_angle['data'] = np.linspace(0.5, 15., n_sweeps).astype(np.float32)
+    radar.elevation['data'] = np.repeat(radar.fixed_angle['data'], n_rays)
+    radar.time['units'] = 'seconds since ' + fecha
+    radar.metadata['instrument_name'] = 'RMA1'
+
+    ranges = {'DBZH': (-10., 60.), 'ZDR': (-1., 5.), 'RHOHV': (0.5, 1.), 'KDP': (-1., 5.),
+              'PHIDP': (0., 180.), 'VRAD': (-30., 30.), 'WRAD': (0., 8.), 'TH': (-10., 60.)}
+    shape = (radar.nrays, radar.ngates)
+    for field in fields:
+        low,high = ranges[field]
+        data = rng.uniform(low, high, shape).astype(np.float32)
+        mask = rng.random(shape) < 0.05
+        radar.add_field(field, {'data': np.ma.masked_array(data, mask=mask),
+                                'units': 'unitless',
+                                '_FillValue': -9999.})
+
+    pyart.io.write_cfradial(path, radar)
+    return radar
+
+
+
+def random_stations(n, radius_km=100., seed=1):
+    """
+    Genera n estaciones al azar dentro de radius_km del RMA1.
+    Devuelve (nombres, latitudes, longitudes).
+    """
+    rng = np.random.default_rng(seed)
+    lat0,lon0 = funciones.RADAR_SITES['RMA1']
+    r = radius_km*np.sqrt(rng.random(n))
+    theta = rng.uniform(0, 2*np.pi, n)
+    lats = lat0 + r*np.cos(theta)/111.
+    lons = lon0 + r*np.sin(theta)/(111.*np.cos(np.radians(lat0)))
+    names = ['est%05d' % k for k in range(n)]
+    return names,lats,lons
+
+
+
+def measure(func, repeat=3, items=1):
+    """
+    Mide func(): latencia (mediana y minimo de repeat llamadas), throughput (items por
+    segundo con la mediana) y pico de memoria de arrays (tracemalloc, en una llamada
+    aparte para no afectar los tiempos).
+    """
+    # Llamada de calentamiento (caches de indices, imports, cache de disco)
+    func()
+
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    median = statistics.median(times)
+    return {'latency_s': median,
+            'latency_min_s': min(times),
+            'throughput_per_s': items/median if median > 0 else None,
+            'peak_mb': peak/2**20}
+
+
+
+def run_benchmarks(stations=(10, 100, 1000),
+                   n_fields=(1, 3, 6),
+                   windows=(1, 3, 5),
+                   masks=(False, True),
+                   n_sweeps=10,
+                   n_rays=360,
+                   n_gates=480,
+                   repeat=3,
+                   workdir=None,
+                   verbose=False):
+    """
+    Funcion para correr todos los benchmarks sobre un volumen sintetico.
+    Parameters:
+            stations (tuple): Cantidades de estaciones a probar.
+            n_fields (tuple): Cantidades de campos a extraer a probar.
+            windows (tuple): Tamaños de ventana NxN a probar.
+            masks (tuple): Valores de mask a probar.
+            n_sweeps, n_rays, n_gates (int): Tamaño del volumen sintetico.
+            repeat (int): Repeticiones por medicion. Default 3.
+            workdir (str): Directorio para el volumen. None usa un directorio temporal.
+            verbose (bool): True para obtener los print de pantalla. Default False.
+
+    Returns:
+            report (dict): Entorno y lista de resultados (nombre, parametros y medidas).
+    """
+    results = []
+
+    def record(name, params, func, items=1):
+        result = {'name': name, 'params': params}
+        result.update(measure(func, repeat, items))
+        results.append(result)
+        if verbose:
+            print('%-40s %-60s %9.4f s %9.1f MB' % (name, json.dumps(params), result['latency_s'],
+                                                  result['peak_mb']))
+
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        path = os.path.join(tmp, 'synthetic_volume.nc')
+        radar = make_synthetic_volume(path, n_sweeps, n_rays, n_gates)
+        volume = {'n_sweeps': n_sweeps, 'n_rays': n_rays, 'n_gates': n_gates,
+                  'file_mb': os.path.getsize(path)/2**20}
+        # Estaciones dentro del alcance del volumen
+        radius_km = 0.9*radar.range['data'][-1]/1000.
+
+        # 1) Geolocalizacion
+        for n in stations:
+            names,lats,lons = random_stations(n, radius_km)
+            record('get_nearest_gate_azimuth', {'stations': n},
+                   lambda: [funciones.get_nearest_gate_azimuth(radar, lon, lat)
+                            for lat,lon in zip(lats, lons)], items=n)
+            record('get_nearest_gate_azimuth_batch', {'stations': n},
+                   lambda: funciones.get_nearest_gate_azimuth_batch(radar, lons, lats), items=n)
+
+        # 2) y 3) Extractores de un punto
+        names,lats,lons = random_stations(1, radius_km)
+        for nf,mask in itertools.product(n_fields, masks):
+            fields = FIELDS[:nf]
+            params = {'fields': nf, 'mask': mask}
+            record('radar_variable_lat_lon', params,
+                   lambda: funciones.radar_variable_lat_lon(path, fields, lats[0], lons[0], mask=mask))
+            for window in windows:
+                record('radar_variable_window_lat_lon', dict(params, window=window),
+                       lambda: funciones.radar_variable_window_lat_lon(path, fields, lats[0], lons[0],
+                                                                       mask=mask, window=window))
+
+        # 4) Extractor de muchas estaciones
+        for n,nf,window,mask in itertools.product(stations, n_fields, windows, masks):
+            names,lats,lons = random_stations(n, radius_km)
+            fields = FIELDS[:nf]
+            record('radar_variable_window_lat_lon_list',
+                   {'stations': n, 'fields': nf, 'window': window, 'mask': mask},
+                   lambda: funciones.radar_variable_window_lat_lon_list(path, fields, names, lats, lons,
+                                                                        mask=mask, window=window),
+                   items=n)
+
+        # 5) Armado del DataFrame (una fila por estacion, como en un loop de usuario)
+        for n,nf,window in itertools.product(stations, n_fields, windows):
+            names,lats,lons = random_stations(n, radius_km)
+            fields = FIELDS[:nf]
+            result = funciones.radar_variable_window_lat_lon_list(path, fields, names, lats, lons,
+                                                                  window=window)
+            record('create_df_from_radar_windows_vars',
+                   {'stations': n, 'fields': nf, 'window': window},
+                   lambda: [funciones.create_df_from_radar_windows_vars(result['datetime'], result[name], fields)
+                            for name in names], items=n)
+
+        # 6) Tasa de precipitacion
+        dbz = radar.fields['DBZH']['data']
+        zdr = radar.fields['ZDR']['data']
+        gates = dbz.size
+        record('calculate_R_from_Z_R', {'gates': gates},
+               lambda: funciones.calculate_R_from_Z_R(300., 1.4, funciones.db_to_linear(dbz)), items=gates)
+        record('calculate_R_from_Z_ZDR_R', {'gates': gates},
+               lambda: funciones.calculate_R_from_Z_ZDR_R(0.0067, 0.927, -3.43,
+                                                          funciones.db_to_linear(dbz),
+                                                          funciones.db_to_linear(zdr)), items=gates)
+        out = np.empty(dbz.shape, dtype=np.float32)
+        record('rain_rate_volume', {'gates': gates, 'relation': 'Z-R'},
+               lambda: funciones.rain_rate_volume(radar, (300., 1.4), out=out), items=gates)
+        record('rain_rate_volume', {'gates': gates, 'relation': 'Z-ZDR-R'},
+               lambda: funciones.rain_rate_volume(radar, (0.0067, 0.927, -3.43), zdr_field='ZDR', out=out),
+               items=gates)
+
+        # Reflectividad cuantizada en 16 bits (escala 0.01 dB) con tablas precalculadas
+        raw = np.ma.filled(np.round(dbz/0.01), -32768).astype(np.int16)
+        record('db_to_linear_lut', {'gates': gates},
+               lambda: funciones.db_to_linear_lut(raw, 0.01, 0., -32768), items=gates)
+        record('rain_rate_lut', {'gates': gates, 'relation': 'Z-R'},
+               lambda: funciones.rain_rate_lut(raw, (300., 1.4), 0.01, 0., -32768), items=gates)
+
+    return {'environment': _environment(),
+            'volume': volume,
+            'startup': startup_benchmark(repeat=max(repeat, 5)),
+            'results': results}
+
+
+
+# Modulos pesados que 'import funciones' no debe cargar
+HEAVY_MODULES = ('pyart', 'pandas', 'numpy', 'scipy', 'pyproj', 'netCDF4')
+
+_STARTUP_CODE = '''
+import json, resource, sys, time
+t0 = time.perf_counter()
+import funciones
+seconds = time.perf_counter() - t0
+print(json.dumps({'seconds': seconds,
+                  'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  'loaded': [m for m in %r if m in sys.modules]}))
+''' % (HEAVY_MODULES,)
+
+
+
+def startup_benchmark(repeat=5):
+    """
+    Mide el arranque de 'import funciones' en procesos nuevos: tiempo (mediana y minimo),
+    pico de memoria residente del proceso y su diferencia con un interprete que no
+    importa nada, y los modulos pesados que quedaron cargados (deberia ser ninguno).
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    # ru_maxrss esta en kB en Linux y en bytes en macOS
+    scale = 2**20 if sys.platform == 'darwin' else 2**10
+
+    def run(code):
+        out = subprocess.run([sys.executable, '-c', code], cwd=here, check=True,
+                             capture_output=True, text=True).stdout
+        return json.loads(out.strip().splitlines()[-1])
+
+    bare = run('import json, resource; print(json.dumps({"maxrss": '
+               'resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))')
+    runs = [run(_STARTUP_CODE) for _ in range(repeat)]
+    seconds = [r['seconds'] for r in runs]
+    rss = statistics.median(r['maxrss'] for r in runs)/scale
+    return {'import_seconds': statistics.median(seconds),
+            'import_seconds_min': min(seconds),
+            'peak_rss_mb': rss,
+            'import_rss_mb': rss - bare['maxrss']/scale,
+            'heavy_modules_loaded': runs[-1]['loaded']}
+
+
+
+def check_startup(max_seconds, max_mb, repeat=5):
+    """
+    Control de regresion del arranque. Devuelve (ok, startup, mensajes).
+    """
+    startup = startup_benchmark(repeat)
+    errors = []
+    if startup['import_seconds'] > max_seconds:
+        errors.append('import funciones tarda %.3f s (limite %.3f s)' % (startup['import_seconds'], max_seconds))
+    if startup['import_rss_mb'] > max_mb:
+        errors.append('import funciones ocupa %.1f MB (limite %.1f MB)' % (startup['import_rss_mb'], max_mb))
+    if startup['heavy_modules_loaded']:
+        errors.append('import funciones carga %s' % ', '.join(startup['heavy_modules_loaded']))
+    return not errors,startup,errors
+
+
+
+def _environment():
+    """
+    Versiones de Python y de los paquetes para comparar corridas.
+    """
+    versions = {'python': platform.python_version(), 'platform': platform.platform()}
+    for name in ('numpy', 'pandas', 'pyart', 'pyproj', 'netCDF4'):
+        try:
+            versions[name] = __import__(name).__version__
+        except Exception:
+            versions[name] = None
+    return versions
+
+
+
+def _int_list(text):
+    return [int(x) for x in text.split(',') if x]
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks de funciones.py con volumenes sinteticos')
+    parser.add_argument('--stations', type=_int_list, default=[10, 100, 1000])
+    parser.add_argument('--fields', type=_int_list, default=[1, 3, 6])
+    parser.add_argument('--windows', type=_int_list, default=[1, 3, 5])
+    parser.add_argument('--mask', choices=['both', 'on', 'off'], default='both')
+    parser.add_argument('--sweeps', type=int, default=10)
+    parser.add_argument('--rays', type=int, default=360)
+    parser.add_argument('--gates', type=int, default=480)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--output', default=None, help='Archivo JSON de salida (default: stdout)')
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--check', action='store_true',
+                        help='Solo controla el arranque de import funciones contra los limites')
+    parser.add_argument('--max-import-seconds', type=float, default=0.25)
+    parser.add_argument('--max-import-mb', type=float, default=15.)
+    args = parser.parse_args(argv)
+
+    if args.check:
+        ok,startup,errors = check_startup(args.max_import_seconds, args.max_import_mb)
+        print(json.dumps(startup, indent=2))
+        for error in errors:
+            print('ERROR:', error, file=sys.stderr)
+        return 0 if ok else 1
+
+    masks = {'both': (False, True), 'on': (True,), 'off': (False,)}[args.mask]
+    report = run_benchmarks(stations=args.stations,
+                            n_fields=args.fields,
+                            windows=args.windows,
+                            masks=masks,
+                            n_sweeps=args.sweeps,
+                            n_rays=args.rays,
+                            n_gates=args.gates,
+                            repeat=args.repeat,
+                            workdir=args.workdir,
+                            verbose=args.verbose)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
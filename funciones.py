@@ -17,14 +17,244 @@ Created on Wed Jun 1, 2021
 #             8) lat_lon_to_range_azimuth
 #             9) calculate_R_from_Z_R
 #            10) calculate_R_from_Z_ZDR_R
+#            11) get_nearest_gate_azimuth_batch
+#            12) geometry_fingerprint
+#            13) GateIndexCache
+#            14) profile_radar_read
+#            15) extract_station_timeseries
+#            16) radar_variable_window_lat_lon_array
+#            17) qc_mask
+#            18) RadarWindowAccumulator
+#            19) rain_rate_volume
+#            20) radar_datetime
+#            21) RainfallAccumulator
+#            22) RADAR_SITES
+#            23) build_volume_index
+#            24) query_volume_index
+#            25) StationWindowStore
+#            26) MetricsCollector
+#            27) set_instrumentation
+#            28) iter_radar_volumes
+#            29) radar_grid_lat_lon
+#            30) build_grid_weights
+#            31) RadarGridWeights
+#            32) watch_radar_folder
+#            33) radar_variable_profile_lat_lon
+#            34) extract_multi_radar
+#            35) read_raw_field
+#            36) db_to_linear_lut
+#            37) linear_to_db_lut
+#            38) rain_rate_lut
 #-----------------------------------------------------------------
 
-from dateutil.relativedelta import relativedelta
-import pandas as pd
+from collections import OrderedDict, deque
+from contextlib import closing, nullcontext
+import functools
+import importlib
+import hashlib
+import glob
+import json
 import math
-import pyart
-from datetime import datetime
-import numpy as np
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+
+
+class _LazyModule:
+    """
+    Modulo que se importa recien cuando se usa por primera vez. Al importarse reemplaza
+    su nombre en este modulo por el modulo real, asi que despues no tiene costo extra.
+    Permite que 'import funciones' sea rapido: pyart (que tarda segundos e imprime su
+    encabezado), pandas y numpy se cargan solo si una funcion los necesita.
+    """
+
+    def __init__(self, name, alias):
+        self.__dict__['_name'] = name
+        self.__dict__['_alias'] = alias
+
+    def _load(self):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return '<modulo %s sin importar>' % self._name
+
+
+
+pyart = _LazyModule('pyart', 'pyart')
+pd = _LazyModule('pandas', 'pd')
+np = _LazyModule('numpy', 'np')
+# Solo los usan las funciones con procesos/threads y las bases SQLite
+futures = _LazyModule('concurrent.futures', 'futures')
+multiprocessing = _LazyModule('multiprocessing', 'multiprocessing')
+sqlite3 = _LazyModule('sqlite3', 'sqlite3')
+
+
+
+class MetricsCollector:
+    """
+    Colector de metricas de la instrumentacion del modulo (ver set_instrumentation).
+    Acumula por etapa la cantidad de llamadas y el tiempo total (wall time) y suma los
+    contadores (bytes decodificados, campos y gates leidos, aciertos y fallos del cache
+    de indices, etc.). Si se indica callback, ademas se lo llama en cada evento con
+    (tipo, nombre, valor), donde tipo es 'timing' (valor en segundos) o 'count'; sirve
+    para enviar las metricas a un sistema externo.
+
+    Etapas: 'read', 'geolocation', 'mask', 'gather', 'dataframe', 'rain_rate', 'gridding',
+    'write', 'end_to_end' (latencia por volumen de watch_radar_folder).
+    Contadores: 'volumes_read', 'bytes_decoded', 'fields_decoded', 'gates_touched',
+    'stations', 'cache_hits', 'cache_misses', 'cache_disk_hits'.
+
+    Parameters:
+              callback (callable): Funcion callback(tipo, nombre, valor). Default None.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.timings = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def timing(self, stage, seconds):
+        """Registra una ejecucion de la etapa stage que tardo seconds segundos."""
+        with self._lock:
+            calls,total = self.timings.get(stage, (0, 0.))
+            self.timings[stage] = (calls + 1, total + seconds)
+        if self.callback is not None:
+            self.callback('timing', stage, seconds)
+
+    def count(self, name, value=1):
+        """Suma value al contador name."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        if self.callback is not None:
+            self.callback('count', name, value)
+
+    def reset(self):
+        """Pone en cero todas las etapas y contadores."""
+        with self._lock:
+            self.timings.clear()
+            self.counters.clear()
+
+    def summary(self):
+        """
+        Devuelve un dict con 'stages' ({etapa: {'calls', 'seconds'}}) y 'counters'.
+        """
+        with self._lock:
+            stages = {stage: {'calls': calls, 'seconds': total}
+                      for stage,(calls,total) in self.timings.items()}
+            return {'stages': stages, 'counters': dict(self.counters)}
+
+
+
+# Colector activo (None = instrumentacion desactivada)
+_METRICS = None
+_NO_STAGE = nullcontext()
+
+
+
+def set_instrumentation(collector):
+    """
+    Funcion para activar o desactivar la instrumentacion del modulo. Con la
+    instrumentacion activa las funciones registran el tiempo de cada etapa (lectura,
+    geolocalizacion, mascara, extraccion, armado de DataFrames, etc.) y sus contadores
+    en el colector. Desactivada (por defecto) el costo es una comparacion con None.
+    En extract_station_timeseries y extract_multi_radar los eventos de cada proceso de
+    trabajo se registran en el colector activo al recibir su resultado, con la misma
+    granularidad (una llamada por ejecucion de etapa) que en el proceso principal.
+    Parameters:
+              collector (MetricsCollector, callable o None): Colector a usar. Puede ser
+                               cualquier objeto con metodos timing(etapa, segundos) y
+                               count(nombre, valor). Un callable se envuelve en un
+                               MetricsCollector como callback. None la desactiva.
+
+    Returns:
+              previous (MetricsCollector o None): Colector que estaba activo.
+    """
+    global _METRICS
+    if collector is not None and not hasattr(collector, 'timing') and callable(collector):
+        collector = MetricsCollector(callback=collector)
+    previous = _METRICS
+    _METRICS = collector
+    return previous
+
+
+
+class _Stage:
+    """Context manager que mide el tiempo de una etapa para el colector activo."""
+
+    __slots__ = ('collector', 'name', 't0')
+
+    def __init__(self, collector, name):
+        self.collector = collector
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.collector.timing(self.name, time.perf_counter() - self.t0)
+
+
+
+def _stage(name):
+    """
+    Context manager de la etapa name. Sin instrumentacion devuelve un nullcontext compartido.
+    """
+    collector = _METRICS
+    if collector is None:
+        return _NO_STAGE
+    return _Stage(collector, name)
+
+
+
+def _count(name, value=1):
+    """Suma value al contador name del colector activo (si lo hay)."""
+    collector = _METRICS
+    if collector is not None:
+        collector.count(name, value)
+
+
+
+def _instrumented_call(instrument, func, *args):
+    """
+    Ejecuta func(*args) en un proceso de trabajo. Con instrument=True guarda cada evento
+    (tipo, nombre, valor) de la instrumentacion y los devuelve junto al resultado (si
+    no, None), ya que el colector del proceso principal no se comparte con los procesos.
+    """
+    if not instrument:
+        return func(*args), None
+    events = []
+    previous = set_instrumentation(MetricsCollector(callback=lambda *event: events.append(event)))
+    try:
+        result = func(*args)
+    finally:
+        set_instrumentation(previous)
+    return result, events
+
+
+
+def _replay_metrics(events):
+    """
+    Registra en el colector activo, uno por uno, los eventos devueltos por
+    _instrumented_call: cada ejecucion de una etapa cuenta como una llamada.
+    """
+    collector = _METRICS
+    if collector is None or events is None:
+        return
+    for kind,name,value in events:
+        if kind == 'timing':
+            collector.timing(name, value)
+        else:
+            collector.count(name, value)
 
 
 
@@ -46,67 +276,61 @@ def get_nearest_gate_azimuth(radar, longitud, latitud, verbose=False):
               gate (int): es el numero del gate mas cercano al punto
               alfa (int): es el numero de rayo correspondiente al gate mas cercano
     """
-    # Calculo coordenadas x,y de la estacion
-    x,y = pyart.core.geographic_to_cartesian_aeqd(longitud,
-                                                  latitud,
-                                                  radar.longitude['data'][0],
-                                                  radar.latitude['data'][0]) 
+    with _stage('geolocation'):
+        # Calculo coordenadas x,y de la estacion
+        x,y = pyart.core.geographic_to_cartesian_aeqd(longitud,
+                                                      latitud,
+                                                      radar.longitude['data'][0],
+                                                      radar.latitude['data'][0]) 
 
     
 
-    # CALCULO ANGULO Y DISTANCIA AL PLUVIOMETRO
-    r = math.sqrt(x*x+y*y)    
-    if x > 0 and y > 0: # Si el punto x,y esta en el 1er cuadrante
-        alfa = round(abs(math.degrees(math.atan(x/y)))) # Angulo redondeado al entero mas cercano
-        theta = abs(math.degrees(math.atan(x/y)))       # Angulo exacto
-    elif x > 0 and y < 0: # Si el punto x,y esta en el 2do cuadrante
-        alfa = round(abs(math.degrees(math.atan(abs(y)/x)) + 90)) # Angulo redondeado al entero mas cercano
-        theta = abs(math.degrees(math.atan(abs(y)/x)) + 90)       # Angulo exacto
-    elif x < 0 and y > 0: # Si el punto x,y esta en el 4to cuadrante
-        alfa = round(abs(math.degrees(math.atan(y/abs(x))) + 270)) # Angulo redondeado al entero mas cercano
-        theta = abs(math.degrees(math.atan(y/abs(x))) + 270)       # Angulo exacto
-    elif x < 0 and y < 0: # Si el punto x,y esta en el 3er cuadrante
-        alfa = round(abs(math.degrees(math.atan(x/y)) + 180)) # Angulo redondeado al entero mas cercano
-        theta = abs(math.degrees(math.atan(x/y)) + 180)       # Angulo exacto
-
-
-    # DISTANCIA AL PLUVIOMETRO EN KM. Alfa contando desde el Norte geografico en sentido horario
-    r_km = r/1000 # Paso r en metros a r_km en kilometros
-
-    # CALCULO DE LA DISTANCIA DEL 1ER GATE AL RADAR
-    # para el calculo de la distancia al radar
-    first_gate_latitude = radar.gate_latitude['data'][0, 0] # Latitud del primer gate con azimuth 0°
-    first_gate_longitude = radar.gate_longitude['data'][0, 0] # Longitud del primer gate con azimuth 0°
-    first_x,first_y = pyart.core.geographic_to_cartesian_aeqd(first_gate_longitude,
-                                                              first_gate_latitude,
-                                                              radar.longitude['data'][0],
-                                                              radar.latitude['data'][0]) # Coord. x y del 
-                                                                            # primer gate con
-                                                                            # azimuth 0
-    r_first = math.sqrt(first_x*first_x+first_y*first_y) # Distancia al primer gate
-
-    # CALCULO DE LA DISTANCIA DEL 2DO GATE AL RADAR
-    # para el calculo de la distancia al radar
-    second_gate_latitude = radar.gate_latitude['data'][0, 1] # Latitud del segundo gate con azimuth 0°
-    second_gate_longitude = radar.gate_longitude['data'][0, 1] # Latitud del segundo gate con azimuth 0°
-    second_x,second_y = pyart.core.geographic_to_cartesian_aeqd(second_gate_longitude,
-                                                                second_gate_latitude,
-                                                                radar.longitude['data'][0],
-                                                                radar.latitude['data'][0]) # Coord. x y del
-                                                                              # segundo gate
-                                                                              # con azimuth 0
-    r_second = math.sqrt(second_x*second_x+second_y*second_y) # Distancia al segundo gate
-
-    # Distancia entre gates (dist 2do gate<->radar - dist 1er gate<->radar )
-    dist_bet_gates = r_second - r_first 
-
-    # (dist. pluv. - dist. 1st gate) / dist. entre gates = numero de gate
-    gate = round((r-r_first)/dist_bet_gates) 
-
-    # LATITUD, LONGITUD Y ALTITUD DEL GATE MAS CERCANO AL PLUVIOMETRO
-    gate_latitude = radar.gate_latitude['data'][alfa, gate]
-    gate_longitude = radar.gate_longitude['data'][alfa, gate]
-    gate_altitude = radar.gate_altitude['data'][alfa, gate]
+        # CALCULO ANGULO Y DISTANCIA AL PLUVIOMETRO
+        x = float(np.ravel(x)[0])
+        y = float(np.ravel(y)[0])
+        r = math.sqrt(x*x+y*y)
+        # atan2 resuelve los cuatro cuadrantes y tambien los puntos sobre los ejes (x=0 o y=0)
+        theta = math.degrees(math.atan2(x, y)) % 360 # Angulo exacto
+        alfa = round(theta) % 360                    # Angulo redondeado al entero mas cercano
+
+
+        # DISTANCIA AL PLUVIOMETRO EN KM. Alfa contando desde el Norte geografico en sentido horario
+        r_km = r/1000 # Paso r en metros a r_km en kilometros
+
+        # CALCULO DE LA DISTANCIA DEL 1ER GATE AL RADAR
+        # para el calculo de la distancia al radar
+        first_gate_latitude = radar.gate_latitude['data'][0, 0] # Latitud del primer gate con azimuth 0°
+        first_gate_longitude = radar.gate_longitude['data'][0, 0] # Longitud del primer gate con azimuth 0°
+        first_x,first_y = pyart.core.geographic_to_cartesian_aeqd(first_gate_longitude,
+                                                                  first_gate_latitude,
+                                                                  radar.longitude['data'][0],
+                                                                  radar.latitude['data'][0]) # Coord. x y del 
+                                                                                # primer gate con
+                                                                                # azimuth 0
+        r_first = float(np.ravel(np.hypot(first_x, first_y))[0]) # Distancia al primer gate
+
+        # CALCULO DE LA DISTANCIA DEL 2DO GATE AL RADAR
+        # para el calculo de la distancia al radar
+        second_gate_latitude = radar.gate_latitude['data'][0, 1] # Latitud del segundo gate con azimuth 0°
+        second_gate_longitude = radar.gate_longitude['data'][0, 1] # Latitud del segundo gate con azimuth 0°
+        second_x,second_y = pyart.core.geographic_to_cartesian_aeqd(second_gate_longitude,
+                                                                    second_gate_latitude,
+                                                                    radar.longitude['data'][0],
+                                                                    radar.latitude['data'][0]) # Coord. x y del
+                                                                                  # segundo gate
+                                                                                  # con azimuth 0
+        r_second = float(np.ravel(np.hypot(second_x, second_y))[0]) # Distancia al segundo gate
+
+        # Distancia entre gates (dist 2do gate<->radar - dist 1er gate<->radar )
+        dist_bet_gates = r_second - r_first 
+
+        # (dist. pluv. - dist. 1st gate) / dist. entre gates = numero de gate
+        gate = round((r-r_first)/dist_bet_gates) 
+
+        # LATITUD, LONGITUD Y ALTITUD DEL GATE MAS CERCANO AL PLUVIOMETRO
+        gate_latitude = radar.gate_latitude['data'][alfa, gate]
+        gate_longitude = radar.gate_longitude['data'][alfa, gate]
+        gate_altitude = radar.gate_altitude['data'][alfa, gate]
 
     if verbose:
         print('-----------------------------------------------')
@@ -118,75 +342,500 @@ def get_nearest_gate_azimuth(radar, longitud, latitud, verbose=False):
         print('Latidud  ','  Longitud','Altitud')
         print(gate_latitude, gate_longitude, gate_altitude)
         print('-----------------------------------------------')
-    
+
     return gate,alfa
 
 
 
+def get_nearest_gate_azimuth_batch(radar, longitudes, latitudes, sweep=0):
+    """
+    Version vectorizada de get_nearest_gate_azimuth para muchos puntos a la vez.
+    Calcula en una sola pasada de NumPy el gate y el rayo mas cercanos a cada punto
+    usando los vectores reales del volumen (radar.azimuth['data'] y radar.range['data'])
+    en lugar de suponer un rayo por grado entero. Los puntos ubicados sobre los ejes
+    (x=0 o y=0) se resuelven con arctan2.
+    Los puntos que caen mas alla del ultimo gate se asignan al ultimo gate (ver
+    _stations_in_range; los extractores enmascaran esas estaciones).
+
+    Parameters:
+              radar (radar obj): objeto radar
+              longitudes (array o list): longitudes de los puntos (en grados decimales)
+              latitudes (array o list): latitudes de los puntos (en grados decimales)
+              sweep (int): numero de barrido (sweep) sobre el que se buscan los rayos. Default 0.
+
+    Returns:
+              gates (array int): numero del gate mas cercano a cada punto
+              rays (array int): indice del rayo (fila del volumen) mas cercano a cada punto
+    """
+    longitudes = np.atleast_1d(np.asarray(longitudes, dtype=float))
+    latitudes = np.atleast_1d(np.asarray(latitudes, dtype=float))
+
+    # Coordenadas x,y de todos los puntos en una sola llamada
+    x,y = pyart.core.geographic_to_cartesian_aeqd(longitudes,
+                                                  latitudes,
+                                                  radar.longitude['data'][0],
+                                                  radar.latitude['data'][0])
+
+    # Angulo contando desde el norte en sentido horario y distancia sobre la superficie
+    theta = np.degrees(np.arctan2(x, y)) % 360.
+    r = np.hypot(x, y)
+
+    # Rayos del barrido pedido
+    start = int(radar.sweep_start_ray_index['data'][sweep])
+    end = int(radar.sweep_end_ray_index['data'][sweep])
+    azimuths = np.asarray(radar.azimuth['data'][start:end+1], dtype=float)
+
+    # Distancia sobre la superficie de cada gate para la elevacion del barrido
+    gate_distance = _gate_ground_distance(radar, sweep)
+
+    gates = _nearest_sorted_index(gate_distance, r)
+    rays = start + _nearest_azimuth_index(azimuths, theta)
+
+    return gates,rays
+
+
+
+def _gate_ground_distance(radar, sweep=0):
+    """
+    Distancia sobre la superficie (en metros) de cada gate para la elevacion del barrido.
+    """
+    elevation = float(radar.fixed_angle['data'][sweep])
+    gate_x,gate_y,_ = pyart.core.antenna_to_cartesian(np.asarray(radar.range['data'], dtype=float)/1000.,
+                                                      0.,
+                                                      elevation)
+    return np.hypot(gate_x, gate_y)
+
+
+
+def _max_ground_range(radar, sweep=0):
+    """
+    Alcance del barrido sobre la superficie (en metros): hasta medio gate mas alla del
+    ultimo gate.
+    """
+    gate_distance = _gate_ground_distance(radar, sweep)
+    spacing = gate_distance[-1] - gate_distance[-2] if gate_distance.size > 1 else 0.
+    return gate_distance[-1] + spacing/2
+
+
+
+def _stations_in_range(radar, longitudes, latitudes, gates, sweep=0):
+    """
+    True para las estaciones dentro del alcance del barrido (_max_ground_range).
+    get_nearest_gate_azimuth_batch asigna al ultimo gate las estaciones fuera de
+    alcance, asi que solo se calcula la distancia de las asignadas al ultimo gate.
+    """
+    gates = np.asarray(gates)
+    inside = np.ones(gates.shape, dtype=bool)
+    last = np.nonzero(gates == radar.ngates - 1)[0]
+    if last.size:
+        longitudes = np.atleast_1d(np.asarray(longitudes, dtype=float))[last]
+        latitudes = np.atleast_1d(np.asarray(latitudes, dtype=float))[last]
+        x,y = pyart.core.geographic_to_cartesian_aeqd(longitudes,
+                                                      latitudes,
+                                                      radar.longitude['data'][0],
+                                                      radar.latitude['data'][0])
+        inside[last] = np.hypot(x, y) <= _max_ground_range(radar, sweep)
+    return inside
+
+
+
+def _nearest_sorted_index(values, targets):
+    """
+    Indice del elemento de values (ordenado de forma creciente) mas cercano a cada
+    valor de targets. Los valores fuera del rango se asignan al extremo mas cercano.
+    """
+    values = np.asarray(values)
+    if values.size == 1:
+        return np.zeros(np.shape(targets), dtype=int)
+    idx = np.clip(np.searchsorted(values, targets), 1, values.size - 1)
+    # Elijo entre el vecino de la izquierda y el de la derecha
+    left_closer = (targets - values[idx-1]) <= (values[idx] - targets)
+    return np.where(left_closer, idx - 1, idx).astype(int)
+
+
+
+def _nearest_azimuth_index(azimuths, theta):
+    """
+    Indice del azimuth mas cercano a cada angulo de theta teniendo en cuenta que el
+    angulo es ciclico (359° y 1° estan a 2° de distancia). Los azimuths no necesitan
+    estar ordenados ni empezar en 0°.
+    """
+    azimuths = np.asarray(azimuths) % 360.
+    order = np.argsort(azimuths, kind='stable')
+    sorted_az = azimuths[order]
+    n = sorted_az.size
+
+    # Candidatos: el azimuth inmediatamente anterior y el inmediatamente posterior (con vuelta)
+    right = np.searchsorted(sorted_az, theta) % n
+    left = (right - 1) % n
+    dist_right = np.abs((theta - sorted_az[right] + 180.) % 360. - 180.)
+    dist_left = np.abs((theta - sorted_az[left] + 180.) % 360. - 180.)
+
+    return order[np.where(dist_left <= dist_right, left, right)]
+
+
+
+def geometry_fingerprint(radar):
+    """
+    Funcion para calcular una huella (hash) de la geometria de un volumen de radar:
+    ubicacion del sitio, vector de azimuths, vector de rangos y disposicion de los
+    barridos (rayos de inicio/fin y angulos fijos). Dos volumenes con la misma
+    estrategia de escaneo tienen la misma huella.
+    Los azimuths y angulos se redondean a 0.1° para que el ruido del posicionamiento
+    de la antena entre volumenes no cambie la huella.
+
+    Parameters:
+              radar (radar obj): objeto radar
+
+    Returns:
+              fingerprint (str): huella hexadecimal de la geometria del volumen
+    """
+    h = hashlib.sha1()
+    parts = [(radar.latitude['data'], 4),
+             (radar.longitude['data'], 4),
+             (radar.altitude['data'], 0),
+             (radar.azimuth['data'], 1),
+             (radar.range['data'], 0),
+             (radar.sweep_start_ray_index['data'], 0),
+             (radar.sweep_end_ray_index['data'], 0),
+             (radar.fixed_angle['data'], 1)]
+    for data,decimals in parts:
+        values = np.round(np.asarray(data, dtype=np.float64), decimals)
+        h.update(np.ascontiguousarray(values).tobytes())
+        # Separador para que dos vectores contiguos no se confundan
+        h.update(b'|')
+    return h.hexdigest()
+
+
+
+class GateIndexCache:
+    """
+    Cache de las tablas estacion -> (gate, rayo) calculadas con
+    get_nearest_gate_azimuth_batch. La clave es la huella de la geometria del volumen
+    (geometry_fingerprint), la huella de las coordenadas de las estaciones y el barrido.
+    Las tablas se guardan en memoria con descarte LRU y opcionalmente en disco (un
+    archivo .npz por tabla) para reutilizarlas entre ejecuciones.
+
+    Parameters:
+              maxsize (int): cantidad maxima de tablas en memoria. Default 32.
+              cache_dir (str): directorio para la copia en disco. None para no usar disco.
+                               Default None.
+    """
+
+    def __init__(self, maxsize=32, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._tables = OrderedDict()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._tables)
+
+    def clear(self):
+        """Vacia las tablas en memoria (la copia en disco no se borra)."""
+        self._tables.clear()
+
+    def get_indices(self, radar, longitudes, latitudes, sweep=0):
+        """
+        Devuelve los indices (gates, rays) de cada estacion. Si la geometria del
+        volumen ya esta en cache la extraccion es solo indexado de arrays.
+
+        Parameters:
+                  radar (radar obj): objeto radar
+                  longitudes (array o list): longitudes de las estaciones
+                  latitudes (array o list): latitudes de las estaciones
+                  sweep (int): numero de barrido. Default 0.
+
+        Returns:
+                  gates (array int): numero del gate mas cercano a cada estacion
+                  rays (array int): indice del rayo mas cercano a cada estacion
+        """
+        longitudes = np.atleast_1d(np.asarray(longitudes, dtype=np.float64))
+        latitudes = np.atleast_1d(np.asarray(latitudes, dtype=np.float64))
+        points = hashlib.sha1(longitudes.tobytes() + b'|' + latitudes.tobytes()).hexdigest()
+        key = '%s_%s_%d' % (geometry_fingerprint(radar), points, sweep)
+
+        # 1) Memoria
+        if key in self._tables:
+            self._tables.move_to_end(key)
+            self.hits += 1
+            _count('cache_hits')
+            return self._tables[key]
+
+        # 2) Disco
+        table = None
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, key + '.npz')
+            if os.path.exists(path):
+                with np.load(path) as npz:
+                    table = (npz['gates'], npz['rays'])
+
+        if table is None:
+            # 3) Calculo
+            self.misses += 1
+            _count('cache_misses')
+            table = get_nearest_gate_azimuth_batch(radar, longitudes, latitudes, sweep)
+            if self.cache_dir is not None:
+                np.savez(os.path.join(self.cache_dir, key + '.npz'), gates=table[0], rays=table[1])
+        else:
+            self.hits += 1
+            _count('cache_hits')
+            _count('cache_disk_hits')
+
+        self._tables[key] = table
+        if len(self._tables) > self.maxsize:
+            # Descarto la tabla usada hace mas tiempo
+            self._tables.popitem(last=False)
+        return table
+
+
+
+# Cache de indices compartido por los extractores radar_variable_*
+_GATE_INDEX_CACHE = GateIndexCache()
+
+
+
+def _station_indices(radar, longitudes, latitudes, cache=None, sweep=0):
+    """
+    Indices (gates, rays) de las estaciones usando el cache indicado. None usa el
+    cache del modulo y False calcula sin cache.
+    """
+    _count('stations', np.size(longitudes))
+    with _stage('geolocation'):
+        if cache is False:
+            return get_nearest_gate_azimuth_batch(radar, longitudes, latitudes, sweep)
+        if cache is None:
+            cache = _GATE_INDEX_CACHE
+        return cache.get_indices(radar, longitudes, latitudes, sweep)
+
+
+
+def radar_datetime(radar):
+    """
+    Funcion para obtener la fecha y hora de un volumen de radar a partir de
+    radar.time['units'] (por ejemplo 'seconds since 2021-01-01T12:30:00Z').
+    Parameters:
+              radar (radar obj): objeto radar
+
+    Returns:
+              fecha (DateTime object): Fecha y hora del volumen de radar
+    """
+    return datetime.strptime(radar.time['units'][14:], '%Y-%m-%dT%H:%M:%SZ')
+
+
+
+def _read_radar(radarfilepath, fields, qc_fields=()):
+    """
+    Lee un volumen decodificando solo los campos pedidos mas los campos de control de
+    calidad (include_fields). Con fields=None se decodifican todos los campos. pyart
+    decodifica todos los barridos de esos campos; los extractores indexan el barrido de
+    interes sobre el volumen completo, sin copiarlo. Si radarfilepath ya es un objeto
+    radar (por ejemplo de iter_radar_volumes) se devuelve tal cual.
+    """
+    if not isinstance(radarfilepath, (str, bytes, os.PathLike)):
+        return radarfilepath
+
+    if fields is None:
+        include_fields = None
+    else:
+        include_fields = list(dict.fromkeys(list(fields) + list(qc_fields)))
+    with _stage('read'):
+        radar = pyart.io.read(radarfilepath, include_fields=include_fields)
+    if _METRICS is not None:
+        _count('volumes_read')
+        _count('fields_decoded', len(radar.fields))
+        _count('bytes_decoded', _radar_nbytes(radar))
+    return radar
+
+
+
+def _radar_nbytes(radar):
+    """Bytes ocupados por los datos decodificados de los campos de un objeto radar."""
+    return sum(np.ma.getdata(field['data']).nbytes for field in radar.fields.values())
+
+
+
+def iter_radar_volumes(volumes,
+                       fields=None,
+                       qc_fields=(),
+                       sweep=None,
+                       prefetch=2,
+                       max_bytes=None,
+                       workers=1,
+                       index_db=None,
+                       start=None,
+                       end=None,
+                       site=None,
+                       verbose=False):
+    """
+    Generador que lee los volumenes por adelantado: mientras se procesa un volumen,
+    los siguientes (hasta prefetch) se leen y decodifican en un pool de threads. Asi el
+    tiempo total queda limitado por el mas lento entre la lectura (por ejemplo desde un
+    disco de red) y el procesamiento, no por la suma de ambos.
+    Los volumenes se devuelven en orden de fecha/hora: el del indice (index_db) o el de
+    la fecha en el nombre del archivo (ej. RMA1_0315_01_20210101T120000Z.nc o
+    cfrad.20210101_120000...). Los objetos radar se pueden pasar directamente a los
+    extractores radar_variable_* en lugar del path:
+
+        for path,radar in iter_radar_volumes('/datos/RMA1', fields=['DBZH','RHOHV']):
+            result = radar_variable_window_lat_lon_list(radar, ['DBZH'], nombres, lats, lons)
+
+    Los volumenes que no se pueden leer se informan y se saltean.
+    Parameters:
+            volumes (str o list): Directorio, patron glob o lista de paths a los volumenes.
+                                  Se ignora si se indica index_db.
+            fields (str o list): Campos a decodificar. None decodifica todos. Default None.
+            qc_fields (list): Campos de control de calidad a decodificar ademas de fields
+                              (ej. ['RHOHV'] para mask=True). Default ().
+            sweep (int): Barrido a conservar. Se copia solo ese barrido despues de leer
+                         el volumen, lo que reduce la memoria de la cola de lectura (no la
+                         decodificacion); los extractores se llaman entonces con sweep=0.
+                         None conserva todos y el barrido se elige al llamar a los
+                         extractores, sin copias. Default None.
+            prefetch (int): Cantidad K de volumenes leidos por adelantado. Default 2.
+            max_bytes (int): Maximo de bytes decodificados en la cola de lectura. Limita K
+                             segun el tamaño del mayor volumen leido hasta el momento.
+                             None no limita. Default None.
+            workers (int): Cantidad de threads de lectura. La libreria HDF5 de netCDF4 en
+                           general no admite lecturas simultaneas desde varios threads, por lo
+                           que solo conviene usar mas de uno con formatos que si lo admitan.
+                           Default 1.
+            index_db (str): Indice SQLite de build_volume_index. Si se indica, los volumenes
+                            se seleccionan con query_volume_index(index_db, start, end, site).
+                            Default None.
+            start (datetime): Fecha/hora inicial (inclusive) para index_db. Default None.
+            end (datetime): Fecha/hora final (inclusive) para index_db. Default None.
+            site (str): Sitio del radar para index_db (ej. 'RMA1'). Default None.
+            verbose (bool): True para obtener los print de pantalla. Default False.
+
+    Returns:
+            (path, radar) (tuple): Path y objeto radar de cada volumen, en orden de fecha/hora.
+    """
+    if isinstance(fields, str):
+        fields = [fields]
+
+    if index_db is not None:
+        paths = query_volume_index(index_db, start=start, end=end, site=site)
+    else:
+        paths = sorted(_list_volumes(volumes), key=_volume_sort_key)
+
+    prefetch = max(int(prefetch), 1)
+
+    # Cola FIFO de lecturas en vuelo (path, future); el orden de la cola es el de salida
+    queue = deque()
+    path_iter = iter(paths)
+    # Tamaño estimado de un volumen decodificado: el mayor leido hasta el momento
+    # (antes de la primera lectura, el tamaño del archivo)
+    volume_bytes = 0
+
+    executor = futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            # Lleno la cola hasta prefetch volumenes (o hasta max_bytes)
+            while len(queue) < prefetch:
+                if max_bytes is not None and queue and (len(queue) + 1)*volume_bytes > max_bytes:
+                    break
+                try:
+                    path = next(path_iter)
+                except StopIteration:
+                    break
+                if volume_bytes == 0 and isinstance(path, str) and os.path.exists(path):
+                    volume_bytes = os.path.getsize(path)
+                queue.append((path, executor.submit(_read_radar_sweep, path, fields, qc_fields, sweep)))
+            if not queue:
+                break
+
+            path,future = queue.popleft()
+            try:
+                radar = future.result()
+            except Exception as error:
+                print('Error al leer el volumen', path, ':', error)
+                continue
+            volume_bytes = max(volume_bytes, _radar_nbytes(radar))
+            if verbose:
+                print('Leido', path, '(%d en cola)' % len(queue))
+            yield path,radar
+            del radar
+    finally:
+        # Si el generador se cierra antes de terminar se descartan las lecturas pendientes
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+
+def _read_radar_sweep(path, fields, qc_fields, sweep):
+    """Lectura de iter_radar_volumes: _read_radar y, si sweep no es None, solo ese barrido."""
+    radar = _read_radar(path, fields, qc_fields)
+    if sweep is not None:
+        radar = radar.extract_sweeps([sweep])
+    return radar
+
+
+
+# Fecha/hora en el nombre de los volumenes: AAAAMMDD seguido de HHMMSS (con 'T' o '_')
+_VOLUME_NAME_DATETIME = re.compile(r'(\d{8})[T_]?(\d{6})')
+
+
+
+def _volume_sort_key(path):
+    """
+    Clave para ordenar los volumenes por la fecha/hora de su nombre (y por path si el
+    nombre no tiene fecha).
+    """
+    match = _VOLUME_NAME_DATETIME.search(os.path.basename(path))
+    if match is None:
+        return ('', path)
+    return (match.group(1) + match.group(2), path)
+
+
+
 def radar_variable_lat_lon(radarfilepath,
                            fields,
                            lat,
                            lon,
                            rhohv_field='RHOHV',
                            rhohv_threshold=0.8,
-                           mask=False):
+                           mask=False,
+                           cache=None,
+                           sweep=0,
+                           qc=None):
     """
     Función para obtener los valores de variables de radar sobre un punto con coordenadas
     lat y lon. La salida es una tupla: Fecha y lista con los valores extraidos.
     Parameters:
-            radarfilepath (str): Path al archivo volumen de radar.
+            radarfilepath (str o radar obj): Path al archivo volumen de radar u objeto radar
+                                             ya leido (ver iter_radar_volumes).
             fields (str o list): Nombres de los campos de radar a extraer el valor.
             lat (float): Latitud en grados decimales.
             lon (float): Longitud en grados decimales.
             rhohv_field (str): Nombre del campo RHOHV. Default 'RHOHV'.
             rhohv_threshold (float): Valor de RHOHV (0 a 1) para aplicar mascara. Default 0.8.
             mask (bool): True para aplicar mascara. Default False.
+            cache (GateIndexCache o False): Cache de indices (gate, rayo) a usar. None usa el
+                                            cache del modulo y False lo desactiva. Default None.
+            sweep (int): Numero de barrido del que se extraen los valores. Default 0.
+            qc (dict): Criterios adicionales de control de calidad para mask=True (ver
+                       qc_mask). Default None.
 
     Returns:
             fecha (DateTime object): Fecha y hora del volumen de radar
             result (list): Lista con los valores de interes. Estan ordenados de la misma
                            manera que se ingresan en la variable fields.
     """
-    
-    # Creamos el objeto "radar" con los campos definidos en include_fields
-    radar = pyart.io.read(radarfilepath)
-
-    # Extraemos la fecha
-    fecha = radar.time['units'][14:]
 
-    # La convertimos en un objeto datetime con el módulo datetime 
-    fecha = datetime.strptime(fecha, '%Y-%m-%dT%H:%M:%SZ')
-    
-    field_dict = {}
-    
-    if mask:
-        for field in fields:
-            try:
-                # Enmascaro los valores de los campos indicados
-                field_dict[field] = np.ma.masked_where(radar.fields[rhohv_field]['data'] < rhohv_threshold,
-                                                       radar.fields[field]['data'])
-            except KeyError:
-                print('Error. Campo no encontrado. Los campos disponibles en el volumen son',radar.fields.keys())
+    # Una ventana de 1x1 es el valor del gate mas cercano
+    fecha,values = radar_variable_window_lat_lon_array(radarfilepath, fields, [lat], [lon],
+                                                       window=1,
+                                                       rhohv_field=rhohv_field,
+                                                       rhohv_threshold=rhohv_threshold,
+                                                       mask=mask,
+                                                       cache=cache,
+                                                       sweep=sweep,
+                                                       qc=qc)
+    result = [values[0,k,0,0] for k in range(values.shape[1])]
 
-    else:
-        for field in fields:
-            try:
-                field_dict[field] = radar.fields[field]['data']
-            except KeyError:
-                print('Error. Campo no encontrado. Los campos disponibles son:',radar.fields.keys())
-            
-            
-    # Funcion para calcular el gate y azimuth sobre las coordenadas
-    gate,alfa = get_nearest_gate_azimuth(radar, lon, lat)
-    
-    result = []
-    
-    for field in fields:
-        # Extraigo los valores de los campos enmascarados
-        value = field_dict[field][alfa,gate]
-        result.append(value)
-        
-    del radar,field_dict
     return fecha,result
 
 
@@ -197,13 +846,17 @@ def radar_variable_window_lat_lon(radarfilepath,
                                   lon,
                                   rhohv_field='RHOHV',
                                   rhohv_threshold=0.8,
-                                  mask=False):
+                                  mask=False,
+                                  cache=None,
+                                  sweep=0,
+                                  window=3,
+                                  qc=None):
     
     """
-    Función para obtener los valores de variables de radar en una ventana de 3x3 celdas
-    centradas sobre un punto con coordenadas lat y lon.
-    La salida es una tupla: Fecha y lista de arrays 3x3 con los valores extraidos.
-    La disposición de la malla de celdas es la siguiente:
+    Función para obtener los valores de variables de radar en una ventana de NxN celdas
+    (3x3 por defecto) centradas sobre un punto con coordenadas lat y lon.
+    La salida es una tupla: Fecha y lista de arrays NxN con los valores extraidos.
+    La disposición de la malla de celdas es la siguiente (caso 3x3):
     
             | alfa-1 | alfa  | alfa+1 |
      ----------------------------------
@@ -212,71 +865,37 @@ def radar_variable_window_lat_lon(radarfilepath,
      gate-1 | [2,0]  | [2,1] |  [2,2] |
      ----------------------------------
     Parameters:
-            radarfilepath (str): Path al archivo volumen de radar.
+            radarfilepath (str o radar obj): Path al archivo volumen de radar u objeto radar
+                                             ya leido (ver iter_radar_volumes).
             fields (str o list): Nombres de los campos de radar a extraer el valor.
             lat (float): Latitud en grados decimales.
             lon (float): Longitud en grados decimales.
             rhohv_field (str): Nombre del campo RHOHV. Default 'RHOHV'.
             rhohv_threshold (float): Valor de RHOHV (0 a 1) para aplicar mascara. Default 0.8.
             mask (bool): True para aplicar mascara. Default False.
+            cache (GateIndexCache o False): Cache de indices (gate, rayo) a usar. None usa el
+                                            cache del modulo y False lo desactiva. Default None.
+            sweep (int): Numero de barrido del que se extraen los valores. Default 0.
+            window (int): Tamaño N (impar) de la ventana NxN. Default 3.
+            qc (dict): Criterios adicionales de control de calidad para mask=True (ver
+                       qc_mask). Default None.
 
     Returns:
             fecha (DateTime object): Fecha y hora del volumen de radar
-            result (list): Lista de los arrays con los valores de interes.
+            result (list): Lista de los arrays (masked float32 NxN) con los valores de interes.
                            Estan ordenados de la misma manera que se ingresan en la variable fields.
     """
-    
-    # Creamos el objeto "radar" con los campos definidos en include_fields
-    radar = pyart.io.read(radarfilepath)
-
-    # Extraemos la fecha
-    fecha = radar.time['units'][14:]
 
-    # La convertimos en un objeto datetime con el módulo datetime 
-    fecha = datetime.strptime(fecha, '%Y-%m-%dT%H:%M:%SZ')
-    
-    field_dict = {}
-    
-    if mask:
-        for field in fields:
-            try:
-                # Enmascaro los valores de los campos indicados
-                field_dict[field] = np.ma.masked_where(radar.fields[rhohv_field]['data'] < rhohv_threshold,
-                                                       radar.fields[field]['data'])
-            except KeyError:
-                print('Error. Campo no encontrado. Los campos disponibles en el volumen son',radar.fields.keys())
+    fecha,values = radar_variable_window_lat_lon_array(radarfilepath, fields, [lat], [lon],
+                                                       window=window,
+                                                       rhohv_field=rhohv_field,
+                                                       rhohv_threshold=rhohv_threshold,
+                                                       mask=mask,
+                                                       cache=cache,
+                                                       sweep=sweep,
+                                                       qc=qc)
+    result = list(values[0])
 
-    else:
-        for field in fields:
-            try:
-                field_dict[field] = radar.fields[field]['data']
-            except KeyError:
-                print('Error. Campo no encontrado. Los campos disponibles son:',radar.fields.keys())
-            
-            
-    # Funcion para calcular el gate y azimuth sobre las coordenadas
-    gate,alfa = get_nearest_gate_azimuth(radar, lon, lat)
-    
-    result = []
-    
-    for field in fields:
-        # np.full([shape], fillvalue)
-        # shape = [number rows, number cols]
-        result_array = np.full([3, 3], None)
-        # Extraigo los valores de los campos enmascarados
-        result_array[0,0] = field_dict[field][alfa-1,gate+1]
-        result_array[0,1] = field_dict[field][alfa  ,gate+1]
-        result_array[0,2] = field_dict[field][alfa+1,gate+1]
-        result_array[1,0] = field_dict[field][alfa-1,gate]
-        result_array[1,1] = field_dict[field][alfa  ,gate]
-        result_array[1,2] = field_dict[field][alfa+1,gate]
-        result_array[2,0] = field_dict[field][alfa-1,gate-1]
-        result_array[2,1] = field_dict[field][alfa  ,gate-1]
-        result_array[2,2] = field_dict[field][alfa+1,gate-1]
-
-        result.append(result_array)
-        
-    del radar,field_dict
     return fecha,result
 
 
@@ -288,13 +907,17 @@ def radar_variable_window_lat_lon_list(radarfilepath,
                                        lon_lst,
                                        rhohv_field='RHOHV',
                                        rhohv_threshold=0.8,
-                                       mask=False):
+                                       mask=False,
+                                       cache=None,
+                                       sweep=0,
+                                       window=3,
+                                       qc=None):
     
     """
-    Función para obtener los valores de variables de radar en una ventana de 3x3 celdas
-    centradas sobre una serie de puntos con coordenadas lat y lon.
-    La salida es un diccionario: Fecha y lista de arrays 3x3 con los valores extraidos.
-    La disposición de la malla de celdas es la siguiente:
+    Función para obtener los valores de variables de radar en una ventana de NxN celdas
+    (3x3 por defecto) centradas sobre una serie de puntos con coordenadas lat y lon.
+    La salida es un diccionario: Fecha y lista de arrays NxN con los valores extraidos.
+    La disposición de la malla de celdas es la siguiente (caso 3x3):
     
             | alfa-1 | alfa  | alfa+1 |
      ----------------------------------
@@ -303,7 +926,8 @@ def radar_variable_window_lat_lon_list(radarfilepath,
      gate-1 | [2,0]  | [2,1] |  [2,2] |
      ----------------------------------
     Parameters:
-            radarfilepath (str): Path al archivo volumen de radar.
+            radarfilepath (str o radar obj): Path al archivo volumen de radar u objeto radar
+                                             ya leido (ver iter_radar_volumes).
             fields (str o list): Nombres de los campos de radar a extraer el valor.
             coords_lst (list): Lista con nombre de referencia de los puntos.
             lat_lst (list): Lista con la latitud en grados decimales.
@@ -311,6 +935,12 @@ def radar_variable_window_lat_lon_list(radarfilepath,
             rhohv_field (str): Nombre del campo RHOHV. Default 'RHOHV'.
             rhohv_threshold (float): Valor de RHOHV (0 a 1) para aplicar mascara. Default 0.8.
             mask (bool): True para aplicar mascara. Default False.
+            cache (GateIndexCache o False): Cache de indices (gate, rayo) a usar. None usa el
+                                            cache del modulo y False lo desactiva. Default None.
+            sweep (int): Numero de barrido del que se extraen los valores. Default 0.
+            window (int): Tamaño N (impar) de la ventana NxN. Default 3.
+            qc (dict): Criterios adicionales de control de calidad para mask=True (ver
+                       qc_mask). Default None.
 
     Returns:
             result (dict): Dict con los resultados.
@@ -318,143 +948,1597 @@ def radar_variable_window_lat_lon_list(radarfilepath,
                            tiene el correspondiente nombre de la lista coords_lst.
                            Ademas tiene una clave datetime con la fecha y hora.
     """
-    
-    # Creamos el objeto "radar" con los campos definidos en include_fields
-    radar = pyart.io.read(radarfilepath)
-
-    # Extraemos la fecha
-    fecha = radar.time['units'][14:]
 
-    # La convertimos en un objeto datetime con el módulo datetime 
-    fecha = datetime.strptime(fecha, '%Y-%m-%dT%H:%M:%SZ')
-    
-    field_dict = {}
-    
-    if mask:
-        for field in fields:
-            try:
-                # Enmascaro los valores de los campos indicados
-                field_dict[field] = np.ma.masked_where(radar.fields[rhohv_field]['data'] < rhohv_threshold,
-                                                       radar.fields[field]['data'])
-            except KeyError:
-                print('Error. Campo no encontrado. Los campos disponibles en el volumen son',radar.fields.keys())
-
-    else:
-        for field in fields:
-            try:
-                field_dict[field] = radar.fields[field]['data']
-            except KeyError:
-                print('Error. Campo no encontrado. Los campos disponibles son:',radar.fields.keys())
-            
+    fecha,values = radar_variable_window_lat_lon_array(radarfilepath, fields, lat_lst, lon_lst,
+                                                       window=window,
+                                                       rhohv_field=rhohv_field,
+                                                       rhohv_threshold=rhohv_threshold,
+                                                       mask=mask,
+                                                       cache=cache,
+                                                       sweep=sweep,
+                                                       qc=qc)
     result = {}
     result['datetime'] = fecha
-    
-    for element in zip(coords_lst,lat_lst,lon_lst):
-        
-        # Funcion para calcular el gate y azimuth sobre las coordenadas
-        #                                            Longitud    Latitud
-        gate,alfa = get_nearest_gate_azimuth(radar, element[2], element[1])
-        result_temp = []
-        
-        for field in fields:
-            # np.full([shape], fillvalue)
-            # shape = [number rows, number cols]
-            result_array = np.full([3, 3], None)
-            # Extraigo los valores de los campos enmascarados
-            result_array[0,0] = field_dict[field][alfa-1,gate+1]
-            result_array[0,1] = field_dict[field][alfa  ,gate+1]
-            result_array[0,2] = field_dict[field][alfa+1,gate+1]
-            result_array[1,0] = field_dict[field][alfa-1,gate]
-            result_array[1,1] = field_dict[field][alfa  ,gate]
-            result_array[1,2] = field_dict[field][alfa+1,gate]
-            result_array[2,0] = field_dict[field][alfa-1,gate-1]
-            result_array[2,1] = field_dict[field][alfa  ,gate-1]
-            result_array[2,2] = field_dict[field][alfa+1,gate-1]
-
-            result_temp.append(result_array)
-            
-        result[element[0]] = result_temp
-        
-    del radar,field_dict
+
+    for k,name in enumerate(coords_lst):
+        result[name] = list(values[k])
+
     return result
 
 
 
-def create_df_from_radar_windows_vars(datetime,var,fields):
+def radar_variable_window_lat_lon_array(radarfilepath,
+                                        fields,
+                                        lat_lst,
+                                        lon_lst,
+                                        window=3,
+                                        rhohv_field='RHOHV',
+                                        rhohv_threshold=0.8,
+                                        mask=False,
+                                        cache=None,
+                                        sweep=0,
+                                        qc=None):
     """
-    Funcion para convertir el array con los valores de radar en una ventana de 3x3
-    en un DataFrame cuya fila es la fecha/hora y en las columnas los valores de
-    cada celda. La notación de las columnas es la misma que la función que la generó
-    (radar_variable_window_lat_lon y radar_variable_window_lat_lon_list). Es decir,
-            | alfa-1 | alfa  | alfa+1 |
-     ----------------------------------
-     gate+1 | [0,0]  | [0,1] |  [0,2] |
-     gate   | [1,0]  | [1,1] |  [1,2] |
-     gate-1 | [2,0]  | [2,1] |  [2,2] |
-     ----------------------------------
+    Función para obtener los valores de variables de radar en ventanas de NxN celdas
+    centradas sobre una serie de puntos con coordenadas lat y lon, como un unico array.
+    Todas las ventanas de todos los campos se extraen con un solo indexado vectorizado.
+    En azimuth la ventana es ciclica dentro del barrido (el vecino del ultimo rayo es el
+    primero) y en rango se recorta al primer/ultimo gate.
+    La disposición de la malla de celdas es la misma de radar_variable_window_lat_lon: la
+    fila i corresponde al gate + N//2 - i y la columna j al rayo alfa - N//2 + j.
     Parameters:
-            datetime (datetime obj): Objeto datetime con la fecha y hora del volumen.
-            var (tuple): Tupla con la salida de la función (radar_variable_window_lat_lon
-                         o radar_variable_window_lat_lon_list).
-            fields (lst o str): Lista o str de los campos extraidos en var. Debe coincidir
-                                con los definidos en la función (radar_variable_window_lat_lon
-                                o radar_variable_window_lat_lon_list).
+            radarfilepath (str o radar obj): Path al archivo volumen de radar u objeto radar
+                                             ya leido (ver iter_radar_volumes).
+            fields (str o list): Nombres de los campos de radar a extraer el valor.
+            lat_lst (list): Lista con la latitud en grados decimales.
+            lon_lst (list): Lista con la longitud en grados decimales.
+            window (int): Tamaño N (impar) de la ventana NxN. Default 3.
+            rhohv_field (str): Nombre del campo RHOHV. Default 'RHOHV'.
+            rhohv_threshold (float): Valor de RHOHV (0 a 1) para aplicar mascara. Default 0.8.
+            mask (bool): True para aplicar mascara. Default False.
+            cache (GateIndexCache o False): Cache de indices (gate, rayo) a usar. None usa el
+                                            cache del modulo y False lo desactiva. Default None.
+            sweep (int): Numero de barrido del que se extraen los valores. Default 0.
+            qc (dict): Criterios adicionales de control de calidad para mask=True, con las
+                       claves de qc_mask (snr_field, snr_threshold, dbzh_field, min_dbzh,
+                       clutter_field). Default None.
 
     Returns:
-            df (DataFrame): DataFrame de Pandas con los resultados.
+            fecha (DateTime object): Fecha y hora del volumen de radar
+            result (masked array): Array float32 de dimensiones (estaciones, campos, N, N).
+                                   Los campos estan ordenados como en la variable fields.
     """
+    _check_window(window)
+    if isinstance(fields, str):
+        fields = [fields]
 
-    # Bloque Try de control de la variable var
-    for x in range(len(var)):
-        try:
-            dim = var[x].shape
-            if dim != (3,3):
-                print('Las dimensiones de las variables son distintas de (3,3)')
-                sys.exit()
-        except:
-            raise ValueError("Las dimensiones de las variables son incorrectas")
-        
-    # Se crea dict vacio
-    data = {}
-    # Indice k para recorrer los campos de var
-    k=0
-    # Recorre los campos dentro de fields
-    for field in fields:
-        # Doble loop para recorrer la malla de celdas
-        for i in [0,1,2]:
-            for j in [0,1,2]:
-                data[field+' ['+str(i)+','+str(j)+']'] = [var[k][i,j]]
-        k=k+1
-
-    # Se agrega la Fecha y Hora
-    data['t radar[ART]'] = datetime
-
-
-    # Se guarda la info en un DataFrame
-    df = pd.DataFrame(data)
-    # Se setea el indice como la Fecha/Hora
-    df.set_index('t radar[ART]',inplace=True)
-    
-    return df
+    qc = dict(qc or {})
+    qc_fields = _qc_fields(rhohv_field, qc, mask)
 
-def db_to_linear(in_df):
-    """
-    Funcion para transformar los valores de las columnas de dB
-    a unidades lineales: La operacion que se realiza es la siguiente:
-    
-                   linear_value = 10**(db_value / 10)
-    Parameters: 
-              in_df (DataFrame): DataFrame de entrada con los valores en db
-    
-    Return:
-              out_df (DataFrame): DataFrame de salida en unidades lineales
-    """
-    
-    return 10**(in_df/10)
+    # Creamos el objeto "radar" solo con los campos pedidos (y los de control de calidad
+    # si se enmascara). El barrido se elige al indexar, sin copiar el volumen
+    radar = _read_radar(radarfilepath, fields, qc_fields)
 
+    # Extraemos la fecha
+    fecha = radar_datetime(radar)
 
+    # Indices del gate y azimuth de todos los puntos en una sola pasada
+    # (reutilizados si la geometria del volumen esta en cache)
+    #                                           Longitud Latitud
+    gates,alfas = _station_indices(radar, lon_lst, lat_lst, cache, sweep)
+    # Las estaciones fuera del alcance del barrido quedan enmascaradas
+    inside = _stations_in_range(radar, lon_lst, lat_lst, gates, sweep)
 
-def linear_to_db(in_df):
+    # Indices (rayo, gate) de cada celda de cada ventana: (estaciones, N, N)
+    ray_idx,gate_idx = _window_indices(radar, gates, alfas, window)
+
+    invalid = None
+    if mask:
+        # La mascara se evalua una sola vez y solo en las celdas extraidas;
+        # se comparte entre todos los campos
+        with _stage('mask'):
+            invalid = qc_mask(radar, ray_idx, gate_idx,
+                              rhohv_field=rhohv_field,
+                              rhohv_threshold=rhohv_threshold,
+                              **qc)
+
+    # Un solo indexado por campo para todas las celdas de todas las estaciones
+    result = _gather_fields(radar, fields, ray_idx, gate_idx, invalid)
+    result.mask[~inside] = True
+    _count('gates_touched', result.size)
+
+    del radar
+    return fecha,result
+
+
+
+def radar_variable_profile_lat_lon(radarfilepath,
+                                   fields,
+                                   lat_lst,
+                                   lon_lst,
+                                   window=3,
+                                   sweeps=None,
+                                   rhohv_field='RHOHV',
+                                   rhohv_threshold=0.8,
+                                   mask=False,
+                                   cache=None,
+                                   qc=None):
+    """
+    Función para obtener el perfil vertical de variables de radar sobre una serie de
+    puntos: las ventanas NxN de cada barrido (elevacion) centradas en el gate mas cercano
+    a cada punto, junto con la altura del haz. Los rayos de cada barrido se toman de
+    radar.sweep_start_ray_index y radar.sweep_end_ray_index, por lo que los barridos
+    pueden tener cualquier cantidad de rayos y empezar en cualquier azimuth.
+    Todas las ventanas de todos los barridos y campos se extraen con un solo indexado
+    vectorizado. La disposición de cada ventana es la de radar_variable_window_lat_lon_array.
+    Parameters:
+            radarfilepath (str o radar obj): Path al archivo volumen de radar u objeto radar
+                                             ya leido (ver iter_radar_volumes).
+            fields (str o list): Nombres de los campos de radar a extraer el valor.
+            lat_lst (list): Lista con la latitud en grados decimales.
+            lon_lst (list): Lista con la longitud en grados decimales.
+            window (int): Tamaño N (impar) de la ventana NxN. Default 3.
+            sweeps (list): Barridos a extraer, en el orden deseado. None para todos.
+                           Default None.
+            rhohv_field (str): Nombre del campo RHOHV. Default 'RHOHV'.
+            rhohv_threshold (float): Valor de RHOHV (0 a 1) para aplicar mascara. Default 0.8.
+            mask (bool): True para aplicar mascara. Default False.
+            cache (GateIndexCache o False): Cache de indices (gate, rayo) a usar. None usa el
+                                            cache del modulo y False lo desactiva. Default None.
+            qc (dict): Criterios adicionales de control de calidad para mask=True (ver
+                       qc_mask). Default None.
+
+    Returns:
+            fecha (DateTime object): Fecha y hora del volumen de radar
+            result (masked array): Array float32 de dimensiones (estaciones, barridos, campos,
+                                   N, N).
+            heights (array): Altura (msnm, de radar.gate_altitude) del centro del gate mas
+                             cercano a cada punto en cada barrido: (estaciones, barridos).
+                             NaN si el punto esta fuera del alcance del barrido.
+    """
+    _check_window(window)
+    if isinstance(fields, str):
+        fields = [fields]
+
+    qc = dict(qc or {})
+    qc_fields = _qc_fields(rhohv_field, qc, mask)
+
+    # Se conservan todos los barridos del volumen
+    radar = _read_radar(radarfilepath, fields, qc_fields)
+    fecha = radar_datetime(radar)
+
+    if sweeps is None:
+        sweeps = range(radar.nsweeps)
+    sweeps = [int(sweep) for sweep in sweeps]
+    n_stations = np.size(lat_lst)
+
+    # Gate y rayo mas cercanos de cada estacion en cada barrido: (barridos, estaciones)
+    indices = [_station_indices(radar, lon_lst, lat_lst, cache, sweep) for sweep in sweeps]
+    gates = np.array([gate for gate,_ in indices], dtype=int).reshape(len(sweeps), n_stations)
+    rays = np.array([ray for _,ray in indices], dtype=int).reshape(len(sweeps), n_stations)
+    # Estaciones dentro del alcance de cada barrido: (estaciones, barridos)
+    inside = np.array([_stations_in_range(radar, lon_lst, lat_lst, gates[k], sweep)
+                       for k,sweep in enumerate(sweeps)]).reshape(len(sweeps), n_stations).T
+
+    # Ventanas de todas las estaciones y barridos: (estaciones, barridos, N, N)
+    ray_idx,gate_idx = _window_indices(radar, gates.T.ravel(), rays.T.ravel(), window)
+    ray_idx = ray_idx.reshape(n_stations, len(sweeps), window, window)
+    gate_idx = gate_idx.reshape(n_stations, len(sweeps), window, window)
+
+    invalid = None
+    if mask:
+        with _stage('mask'):
+            invalid = qc_mask(radar, ray_idx, gate_idx,
+                              rhohv_field=rhohv_field,
+                              rhohv_threshold=rhohv_threshold,
+                              **qc)
+
+    result = _gather_fields(radar, fields, ray_idx, gate_idx, invalid)
+    result.mask[~inside] = True
+    _count('gates_touched', result.size)
+
+    # Altura del haz en el gate central de cada estacion y barrido (NaN fuera de alcance)
+    heights = np.asarray(radar.gate_altitude['data'][rays.T, gates.T], dtype=np.float64)
+    heights[~inside] = np.nan
+
+    del radar
+    return fecha,result,heights
+
+
+
+def qc_mask(radar,
+            rays=None,
+            gates=None,
+            rhohv_field='RHOHV',
+            rhohv_threshold=0.8,
+            snr_field=None,
+            snr_threshold=None,
+            dbzh_field=None,
+            min_dbzh=None,
+            clutter_field=None):
+    """
+    Funcion para calcular la mascara de control de calidad de un volumen una sola vez,
+    para aplicarla luego a todos los campos. Se enmascaran (True) los gates que cumplen
+    alguno de los criterios:
+            - RHOHV menor a rhohv_threshold
+            - SNR menor a snr_threshold (si se indica snr_field)
+            - DBZH menor a min_dbzh (si se indica dbzh_field)
+            - bandera de clutter distinta de 0 (si se indica clutter_field)
+    Los gates con el valor de RHOHV, SNR o DBZH enmascarado tambien se enmascaran.
+    Si se indican rays y gates la mascara se evalua solo en esas celdas (por ejemplo las
+    ventanas de radar_variable_window_lat_lon_array); si no, sobre todo el volumen.
+    Parameters:
+            radar (radar obj): objeto radar
+            rays (array int): Indices de rayo de las celdas a evaluar. Default None.
+            gates (array int): Indices de gate de las celdas a evaluar. Default None.
+            rhohv_field (str): Nombre del campo RHOHV. None para no usarlo. Default 'RHOHV'.
+            rhohv_threshold (float): Valor minimo de RHOHV (0 a 1). Default 0.8.
+            snr_field (str): Nombre del campo SNR. Default None.
+            snr_threshold (float): Valor minimo de SNR en dB. Default None.
+            dbzh_field (str): Nombre del campo de reflectividad. Default None.
+            min_dbzh (float): Valor minimo de reflectividad en dBZ. Default None.
+            clutter_field (str): Nombre del campo con la bandera de clutter. Default None.
+
+    Returns:
+            invalid (array bool): True en las celdas que no pasan el control de calidad.
+                                  Tiene la forma de rays (o (nrays, ngates) si rays es None).
+    """
+    if rays is None:
+        shape = (radar.nrays, radar.ngates)
+    else:
+        shape = np.shape(rays)
+    invalid = np.zeros(shape, dtype=bool)
+
+    def values(field):
+        data = radar.fields[field]['data']
+        return data if rays is None else data[rays,gates]
+
+    # Criterios de umbral minimo: valor < umbral o valor enmascarado
+    for field,threshold in [(rhohv_field, rhohv_threshold),
+                            (snr_field, snr_threshold),
+                            (dbzh_field, min_dbzh)]:
+        if field is not None and threshold is not None:
+            invalid |= np.ma.filled(values(field) < threshold, True)
+
+    # Bandera de clutter: cualquier valor distinto de 0 es clutter
+    if clutter_field is not None:
+        invalid |= np.ma.filled(values(clutter_field) != 0, False)
+
+    return invalid
+
+
+
+def _window_indices(radar, gates, rays, window):
+    """
+    Indices (rayo, gate) de las celdas de las ventanas NxN centradas en cada par
+    (gate, rayo). El azimuth es ciclico dentro del barrido de cada rayo y el rango se
+    recorta a los gates disponibles. Devuelve dos arrays de dimensiones (estaciones, N, N).
+    """
+    half = window // 2
+    gates = np.asarray(gates, dtype=int)
+    rays = np.asarray(rays, dtype=int)
+
+    # Fila i -> gate + half - i ; columna j -> rayo - half + j
+    gate_offset = half - np.arange(window)
+    ray_offset = np.arange(window) - half
+
+    gate_idx = np.clip(gates[:,None,None] + gate_offset[None,:,None], 0, radar.ngates - 1)
+
+    # Barrido al que pertenece cada rayo para dar la vuelta dentro de ese barrido
+    starts = np.asarray(radar.sweep_start_ray_index['data'], dtype=int)
+    ends = np.asarray(radar.sweep_end_ray_index['data'], dtype=int)
+    sweep_of_ray = np.searchsorted(starts, rays, side='right') - 1
+    start = starts[sweep_of_ray][:,None,None]
+    nrays = (ends - starts + 1)[sweep_of_ray][:,None,None]
+    ray_idx = start + (rays[:,None,None] - start + ray_offset[None,None,:]) % nrays
+
+    # Ambos indices con la forma completa (estaciones, N, N)
+    ray_idx,gate_idx = np.broadcast_arrays(ray_idx, gate_idx)
+    return ray_idx,gate_idx
+
+
+
+def _check_window(window):
+    """Verifica que el tamaño de la ventana sea un entero impar positivo."""
+    if window < 1 or window % 2 == 0:
+        raise ValueError('El tamaño de la ventana debe ser un entero impar positivo')
+
+
+
+def _qc_fields(rhohv_field, qc, enabled=True):
+    """
+    Campos que hay que leer para el control de calidad (ver qc_mask): el de RHOHV y los
+    de SNR, DBZH y clutter indicados en qc. Lista vacia si enabled es False.
+    """
+    if not enabled:
+        return []
+    qc = qc or {}
+    return [rhohv_field] + [qc[key] for key in ('snr_field', 'dbzh_field', 'clutter_field')
+                            if qc.get(key) is not None]
+
+
+
+def _gather_fields(radar, fields, ray_idx, gate_idx, invalid=None):
+    """
+    Extrae los campos fields en las celdas (ray_idx, gate_idx), de dimensiones
+    (..., N, N), con un solo indexado por campo. Devuelve un masked array float32 de
+    dimensiones (..., campos, N, N); si se indica invalid (de la forma de los indices)
+    esas celdas quedan enmascaradas en todos los campos.
+    """
+    shape = ray_idx.shape[:-2] + (len(fields),) + ray_idx.shape[-2:]
+    result = np.ma.masked_all(shape, dtype=np.float32)
+    with _stage('gather'):
+        for k,field in enumerate(fields):
+            try:
+                data = radar.fields[field]['data']
+            except KeyError:
+                # Con la lectura selectiva radar.fields solo tiene los campos pedidos,
+                # asi que no sirve para listar los disponibles en el archivo
+                print('Error. El campo', field, 'no esta en el volumen')
+                raise
+            result[...,k,:,:] = data[ray_idx,gate_idx]
+            if invalid is not None:
+                result.mask[...,k,:,:] |= invalid
+    return result
+
+
+
+def profile_radar_read(radarfilepath,
+                       fields,
+                       qc_fields=('RHOHV',),
+                       repeat=3):
+    """
+    Funcion para medir la mejora de la lectura selectiva de un volumen. Compara la
+    lectura completa (pyart.io.read con todos los campos) con la lectura selectiva que
+    usan los extractores radar_variable_* (solo fields + qc_fields; pyart decodifica
+    igual todos los barridos de esos campos).
+    Cada lectura se hace en un proceso nuevo para que el pico de memoria residente (RSS)
+    de un modo no contamine al otro. Tambien se mide el RSS de un proceso que solo importa
+    el modulo (linea de base).
+    Parameters:
+            radarfilepath (str): Path al archivo volumen de radar.
+            fields (str o list): Nombres de los campos de radar a leer.
+            qc_fields (list): Campos de control de calidad a leer. Default ('RHOHV',).
+            repeat (int): Cantidad de lecturas por modo. Se informa la mediana. Default 3.
+
+    Returns:
+            result (dict): Dict con las claves 'baseline', 'full' y 'selective'. Cada una
+                           tiene 'seconds' (mediana del tiempo de lectura) y 'peak_rss_mb'
+                           (maximo del pico de RSS en MB).
+    """
+    if isinstance(fields, str):
+        fields = [fields]
+
+    # Contexto spawn: cada lectura arranca en un proceso limpio
+    context = multiprocessing.get_context('spawn')
+
+    result = {}
+    for mode in ['baseline', 'full', 'selective']:
+        seconds = []
+        peaks = []
+        for _ in range(repeat):
+            with futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                t,peak = executor.submit(_profile_read_worker, radarfilepath, fields,
+                                         qc_fields, mode).result()
+            seconds.append(t)
+            peaks.append(peak)
+        result[mode] = {'seconds': float(np.median(seconds)),
+                        'peak_rss_mb': float(np.max(peaks))}
+
+    return result
+
+
+
+def _profile_read_worker(radarfilepath, fields, qc_fields, mode):
+    """
+    Lectura de un volumen dentro de un proceso nuevo para profile_radar_read.
+    Devuelve el tiempo de lectura en segundos y el pico de RSS del proceso en MB.
+    """
+    import resource
+
+    t0 = time.perf_counter()
+    if mode == 'full':
+        radar = pyart.io.read(radarfilepath)
+    elif mode == 'selective':
+        radar = _read_radar(radarfilepath, fields, qc_fields)
+    else:
+        radar = None
+    seconds = time.perf_counter() - t0
+
+    # ru_maxrss esta en kB en Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+    del radar
+    return seconds,peak
+
+
+
+def create_df_from_radar_windows_vars(datetime,var,fields):
+    """
+    Funcion para convertir el array con los valores de radar en una ventana de 3x3 (o NxN)
+    en un DataFrame cuya fila es la fecha/hora y en las columnas los valores de
+    cada celda. La notación de las columnas es la misma que la función que la generó
+    (radar_variable_window_lat_lon y radar_variable_window_lat_lon_list). Es decir,
+            | alfa-1 | alfa  | alfa+1 |
+     ----------------------------------
+     gate+1 | [0,0]  | [0,1] |  [0,2] |
+     gate   | [1,0]  | [1,1] |  [1,2] |
+     gate-1 | [2,0]  | [2,1] |  [2,2] |
+     ----------------------------------
+    Parameters:
+            datetime (datetime obj): Objeto datetime con la fecha y hora del volumen.
+            var (tuple): Tupla con la salida de la función (radar_variable_window_lat_lon
+                         o radar_variable_window_lat_lon_list).
+            fields (lst o str): Lista o str de los campos extraidos en var. Debe coincidir
+                                con los definidos en la función (radar_variable_window_lat_lon
+                                o radar_variable_window_lat_lon_list).
+
+    Returns:
+            df (DataFrame): DataFrame de Pandas con los resultados.
+    """
+
+    # Control de la variable var: todas las ventanas deben ser NxN con el mismo N
+    try:
+        dims = set(var[x].shape for x in range(len(var)))
+    except AttributeError:
+        raise ValueError("Las dimensiones de las variables son incorrectas")
+    n = var[0].shape[0] if len(var) else 0
+    if dims != {(n, n)}:
+        raise ValueError("Las dimensiones de las variables son incorrectas")
+
+    if isinstance(fields, str):
+        fields = [fields]
+
+    with _stage('dataframe'):
+        # Se crea dict vacio
+        data = {}
+        # Indice k para recorrer los campos de var
+        k=0
+        # Recorre los campos dentro de fields
+        for field in fields:
+            # Doble loop para recorrer la malla de celdas
+            for i in range(n):
+                for j in range(n):
+                    data[field+' ['+str(i)+','+str(j)+']'] = [var[k][i,j]]
+            k=k+1
+
+        # Se agrega la Fecha y Hora
+        data['t radar[ART]'] = datetime
+
+
+        # Se guarda la info en un DataFrame
+        df = pd.DataFrame(data)
+        # Se setea el indice como la Fecha/Hora
+        df.set_index('t radar[ART]',inplace=True)
+
+    return df
+
+
+
+def _window_column_names(fields, window):
+    """
+    Nombres de columnas de las celdas de las ventanas NxN: 'DBZH [0,0]', 'DBZH [0,1]', ...
+    """
+    if isinstance(fields, str):
+        fields = [fields]
+    return [field+' ['+str(i)+','+str(j)+']'
+            for field in fields for i in range(window) for j in range(window)]
+
+
+
+def extract_station_timeseries(volumes,
+                               stations,
+                               fields,
+                               out_dir,
+                               fmt='parquet',
+                               name_col='estacion',
+                               lat_col='lat',
+                               lon_col='lon',
+                               workers=None,
+                               max_pending=None,
+                               chunk_rows=5000,
+                               rhohv_field='RHOHV',
+                               rhohv_threshold=0.8,
+                               mask=False,
+                               sweep=0,
+                               window=3,
+                               qc=None,
+                               index_db=None,
+                               start=None,
+                               end=None,
+                               site=None,
+                               verbose=False):
+    """
+    Funcion para armar la serie temporal de las ventanas de NxN celdas sobre un conjunto
+    de estaciones a partir de muchos volumenes de radar. Los volumenes se reparten en un
+    pool de procesos (cada uno ejecuta radar_variable_window_lat_lon_list) y los resultados
+    se escriben por bloques en archivos Parquet o Feather particionados por dia:
+
+            out_dir/fecha=AAAA-MM-DD/part-<corrida>-<nro>.<fmt>
+
+    La cantidad de volumenes en vuelo esta acotada por max_pending, de modo que la
+    memoria se mantiene constante sin importar cuantos volumenes se procesen.
+    Cada fila es un par (estacion, fecha/hora) y las columnas tienen la misma notacion que
+    create_df_from_radar_windows_vars ('DBZH [0,0]', ...). Los valores enmascarados se
+    guardan como NaN.
+    Requiere pyarrow para escribir Parquet/Feather.
+    Parameters:
+            volumes (str o list): Directorio, patron glob (ej. '/datos/RMA1/**/*.nc') o lista
+                                  de paths a los volumenes. Se ignora si se indica index_db.
+            stations (DataFrame): Tabla de estaciones con nombre, latitud y longitud.
+            fields (str o list): Nombres de los campos de radar a extraer.
+            out_dir (str): Directorio de salida.
+            fmt (str): 'parquet' o 'feather'. Default 'parquet'.
+            name_col (str): Columna de stations con el nombre. Default 'estacion'.
+            lat_col (str): Columna de stations con la latitud. Default 'lat'.
+            lon_col (str): Columna de stations con la longitud. Default 'lon'.
+            workers (int): Cantidad de procesos. None usa os.cpu_count(). Default None.
+            max_pending (int): Maxima cantidad de volumenes en vuelo. None usa 2*workers.
+                               Default None.
+            chunk_rows (int): Cantidad de filas acumuladas antes de escribir a disco.
+                              Default 5000.
+            rhohv_field (str): Nombre del campo RHOHV. Default 'RHOHV'.
+            rhohv_threshold (float): Valor de RHOHV (0 a 1) para aplicar mascara. Default 0.8.
+            mask (bool): True para aplicar mascara. Default False.
+            sweep (int): Numero de barrido a leer. Default 0.
+            window (int): Tamaño N (impar) de la ventana NxN. Default 3.
+            qc (dict): Criterios adicionales de control de calidad para mask=True (ver
+                       qc_mask). Default None.
+            index_db (str): Indice SQLite de build_volume_index. Si se indica, los volumenes
+                            se seleccionan con query_volume_index(index_db, start, end, site).
+                            Default None.
+            start (datetime): Fecha/hora inicial (inclusive) para index_db. Default None.
+            end (datetime): Fecha/hora final (inclusive) para index_db. Default None.
+            site (str): Sitio del radar para index_db (ej. 'RMA1'). Default None.
+            verbose (bool): True para obtener los print de pantalla. Default False.
+
+    Returns:
+            written (list): Lista con los paths de los archivos escritos.
+    """
+    if fmt not in ('parquet', 'feather'):
+        raise ValueError("fmt debe ser 'parquet' o 'feather'")
+    if isinstance(fields, str):
+        fields = [fields]
+
+    if index_db is not None:
+        paths = query_volume_index(index_db, start=start, end=end, site=site)
+    else:
+        paths = _list_volumes(volumes)
+    names = list(stations[name_col])
+    lats = np.asarray(stations[lat_col], dtype=float)
+    lons = np.asarray(stations[lon_col], dtype=float)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 2*workers
+
+    # Identificador de la corrida para no pisar archivos de corridas anteriores
+    run_id = datetime.now().strftime('%Y%m%dT%H%M%S')
+    accumulator = RadarWindowAccumulator(names, fields, window=window)
+    written = []
+    # Los procesos de trabajo no ven el colector activo: devuelven sus eventos
+    instrument = _METRICS is not None
+
+    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        # Futuro -> path del volumen, para informar cual fallo
+        pending = {}
+        path_iter = iter(paths)
+        exhausted = False
+
+        while pending or not exhausted:
+            # Lleno la cola hasta max_pending volumenes en vuelo
+            while not exhausted and len(pending) < max_pending:
+                try:
+                    path = next(path_iter)
+                except StopIteration:
+                    exhausted = True
+                    break
+                future = executor.submit(_instrumented_call, instrument,
+                                         _station_timeseries_worker, path, fields,
+                                         lats, lons, rhohv_field,
+                                         rhohv_threshold, mask, sweep, window, qc)
+                pending[future] = path
+            if not pending:
+                break
+
+            done,_ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    (_,fecha,values),events = future.result()
+                except Exception as error:
+                    print('Error al procesar el volumen', path, ':', error)
+                    continue
+                _replay_metrics(events)
+                if verbose:
+                    print('Procesado', path)
+                accumulator.append(fecha, values)
+
+            if len(accumulator)*len(names) >= chunk_rows:
+                written += _flush_timeseries_buffer(accumulator, out_dir, fmt, run_id, len(written))
+
+    if len(accumulator):
+        written += _flush_timeseries_buffer(accumulator, out_dir, fmt, run_id, len(written))
+
+    return written
+
+
+
+def _list_volumes(volumes, recursive=False):
+    """
+    Lista ordenada de paths a partir de un directorio, un patron glob o una lista de paths.
+    Con recursive=True se recorren tambien los subdirectorios de un directorio.
+    """
+    if isinstance(volumes, (list, tuple)):
+        return sorted(volumes)
+    if os.path.isdir(volumes):
+        if recursive:
+            return sorted(os.path.join(root, name) for root,_,names in os.walk(volumes)
+                          for name in names)
+        return sorted(os.path.join(volumes, name) for name in os.listdir(volumes)
+                      if os.path.isfile(os.path.join(volumes, name)))
+    return sorted(f for f in glob.glob(volumes, recursive=True) if os.path.isfile(f))
+
+
+
+def _station_timeseries_worker(path, fields, lats, lons, rhohv_field,
+                               rhohv_threshold, mask, sweep, window, qc):
+    """
+    Procesa un volumen dentro del pool de extract_station_timeseries. Devuelve el path,
+    la fecha y el array (estaciones, campos, N, N) de radar_variable_window_lat_lon_array.
+    """
+    fecha,values = radar_variable_window_lat_lon_array(path, fields, lats, lons,
+                                                       window=window,
+                                                       rhohv_field=rhohv_field,
+                                                       rhohv_threshold=rhohv_threshold,
+                                                       mask=mask,
+                                                       sweep=sweep,
+                                                       qc=qc)
+    return path,fecha,values
+
+
+
+def _flush_timeseries_buffer(accumulator, out_dir, fmt, run_id, counter):
+    """
+    Vacia el acumulador y escribe las filas de cada dia en su particion fecha=AAAA-MM-DD.
+    """
+    df = accumulator.flush(flat=True).reset_index()
+    df = df.sort_values(['t radar[ART]', 'estacion'])
+    days = df['t radar[ART]'].dt.strftime('%Y-%m-%d')
+
+    written = []
+    with _stage('write'):
+        for day,df_day in df.groupby(days, sort=True):
+            folder = os.path.join(out_dir, 'fecha='+day)
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, 'part-%s-%05d.%s' % (run_id, counter + len(written), fmt))
+            if fmt == 'parquet':
+                df_day.to_parquet(path, index=False)
+            else:
+                df_day.reset_index(drop=True).to_feather(path)
+            written.append(path)
+    return written
+
+
+
+def extract_multi_radar(volumes,
+                        stations,
+                        fields,
+                        rule='nearest',
+                        name_col='estacion',
+                        lat_col='lat',
+                        lon_col='lon',
+                        workers=None,
+                        rhohv_field='RHOHV',
+                        rhohv_threshold=0.8,
+                        mask=False,
+                        sweep=0,
+                        window=3,
+                        qc=None,
+                        verbose=False):
+    """
+    Funcion para extraer las ventanas NxN sobre estaciones a partir de los volumenes de
+    varios radares de un mismo horario (por ejemplo RMA1, RMA2, ... que se superponen).
+    Cada volumen se procesa en un proceso separado y en paralelo, y para cada estacion se
+    elige el radar segun la regla rule entre los que la cubren (estacion dentro del
+    alcance del ultimo gate):
+            'nearest': menor distancia (rango) al radar.
+            'lowest': menor altura del haz sobre la estacion (gate_altitude).
+            'qc': mayor fraccion de celdas de la ventana que pasan el control de calidad
+                  de qc_mask (RHOHV y los criterios de qc); a igualdad, el mas cercano.
+    El resultado tiene una fila por estacion con las columnas de las celdas (con la
+    notacion de create_df_from_radar_windows_vars) y columnas de procedencia: radar
+    elegido, archivo, fecha del volumen, rango, altura del haz, fraccion de celdas
+    validas y cantidad de radares que cubren la estacion. Las estaciones que ningun radar
+    cubre quedan con NaN.
+    Parameters:
+            volumes (list o dict): Paths a los volumenes (uno por radar) o dict
+                                   {sitio: path}. Sin dict, el sitio se toma del volumen.
+            stations (DataFrame): Tabla de estaciones con nombre, latitud y longitud.
+            fields (str o list): Nombres de los campos de radar a extraer.
+            rule (str): 'nearest', 'lowest' o 'qc'. Default 'nearest'.
+            name_col (str): Columna de stations con el nombre. Default 'estacion'.
+            lat_col (str): Columna de stations con la latitud. Default 'lat'.
+            lon_col (str): Columna de stations con la longitud. Default 'lon'.
+            workers (int): Cantidad de procesos. None usa uno por volumen (hasta
+                           os.cpu_count()). 1 procesa en el mismo proceso. Default None.
+            rhohv_field (str): Nombre del campo RHOHV. Default 'RHOHV'.
+            rhohv_threshold (float): Valor de RHOHV (0 a 1) para aplicar mascara. Default 0.8.
+            mask (bool): True para aplicar mascara. Default False.
+            sweep (int): Numero de barrido a leer. Default 0.
+            window (int): Tamaño N (impar) de la ventana NxN. Default 3.
+            qc (dict): Criterios adicionales de control de calidad (ver qc_mask), para
+                       mask=True y para rule='qc'. Default None.
+            verbose (bool): True para obtener los print de pantalla. Default False.
+
+    Returns:
+            df (DataFrame): DataFrame de Pandas indexado por estacion.
+    """
+    if rule not in ('nearest', 'lowest', 'qc'):
+        raise ValueError("rule debe ser 'nearest', 'lowest' o 'qc'")
+    if isinstance(fields, str):
+        fields = [fields]
+    if isinstance(volumes, dict):
+        sites,paths = list(volumes.keys()),list(volumes.values())
+    else:
+        paths = list(volumes)
+        sites = [None]*len(paths)
+
+    names = list(stations[name_col])
+    lats = np.asarray(stations[lat_col], dtype=float)
+    lons = np.asarray(stations[lon_col], dtype=float)
+
+    if workers is None:
+        workers = min(len(paths), os.cpu_count() or 1)
+    args = (fields, lats, lons, rhohv_field, rhohv_threshold, mask, sweep, window, qc,
+            rule == 'qc')
+
+    results = []
+    if workers <= 1:
+        outputs = []
+        for path in paths:
+            try:
+                outputs.append(_multi_radar_worker(path, *args))
+            except Exception as error:
+                print('Error al procesar el volumen', path, ':', error)
+                outputs.append(None)
+    else:
+        with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            instrument = _METRICS is not None
+            jobs = [executor.submit(_instrumented_call, instrument, _multi_radar_worker,
+                                    path, *args) for path in paths]
+            outputs = []
+            for path,job in zip(paths, jobs):
+                try:
+                    output,events = job.result()
+                except Exception as error:
+                    print('Error al procesar el volumen', path, ':', error)
+                    outputs.append(None)
+                    continue
+                _replay_metrics(events)
+                outputs.append(output)
+
+    for site,output in zip(sites, outputs):
+        if output is None:
+            continue
+        if site is not None:
+            output['site'] = site
+        if verbose:
+            print('Procesado', output['site'], output['path'], 'estaciones cubiertas:',
+                  int(output['covered'].sum()))
+        results.append(output)
+
+    n_stations = len(names)
+    columns = _window_column_names(fields, window)
+    values = np.full((n_stations, len(columns)), np.nan, dtype=np.float32)
+    provenance = {'radar': [None]*n_stations,
+                  'archivo': [None]*n_stations,
+                  't radar[ART]': [pd.NaT]*n_stations,
+                  'rango_km': np.full(n_stations, np.nan),
+                  'altura_haz_m': np.full(n_stations, np.nan),
+                  'qc': np.full(n_stations, np.nan),
+                  'n_radares': np.zeros(n_stations, dtype=int)}
+
+    if results:
+        # Puntaje de cada radar (filas) para cada estacion (columnas): menor es mejor
+        covered = np.array([r['covered'] for r in results])
+        if rule == 'nearest':
+            score = np.array([r['range_km'] for r in results])
+        elif rule == 'lowest':
+            score = np.array([r['height'] for r in results])
+        else:
+            # Mayor fraccion valida primero y, a igualdad, menor rango
+            score = np.array([-r['qc'] + 1e-9*r['range_km'] for r in results])
+        score = np.where(covered, score, np.inf)
+        best = np.argmin(score, axis=0)
+        provenance['n_radares'] = covered.sum(axis=0)
+
+        for k,result in enumerate(results):
+            chosen = (best == k) & covered[k]
+            if not chosen.any():
+                continue
+            idx = np.nonzero(chosen)[0]
+            windows = result['values'][idx].reshape(len(idx), -1)
+            values[idx] = np.ma.filled(windows.astype(np.float32), np.nan)
+            for i in idx:
+                provenance['radar'][i] = result['site']
+                provenance['archivo'][i] = result['path']
+                provenance['t radar[ART]'][i] = result['fecha']
+            provenance['rango_km'][idx] = result['range_km'][idx]
+            provenance['altura_haz_m'][idx] = result['height'][idx]
+            provenance['qc'][idx] = result['qc'][idx]
+
+    df = pd.DataFrame(values, index=pd.Index(names, name='estacion'), columns=columns)
+    for column,data in provenance.items():
+        df[column] = data
+    return df
+
+
+
+def _multi_radar_worker(path, fields, lats, lons, rhohv_field, rhohv_threshold,
+                        mask, sweep, window, qc, qc_score):
+    """
+    Procesa el volumen de un radar para extract_multi_radar. Devuelve un dict con el
+    sitio, la fecha, las ventanas (estaciones, campos, N, N) y, por estacion, el rango,
+    la altura del haz, la fraccion de celdas que pasan el control de calidad y si la
+    estacion esta dentro del alcance del radar.
+    """
+    qc = dict(qc or {})
+    qc_fields = _qc_fields(rhohv_field, qc, mask or qc_score)
+    radar = _read_radar(path, fields, qc_fields)
+
+    fecha,values = radar_variable_window_lat_lon_array(radar, fields, lats, lons,
+                                                       window=window,
+                                                       rhohv_field=rhohv_field,
+                                                       rhohv_threshold=rhohv_threshold,
+                                                       mask=mask,
+                                                       sweep=sweep,
+                                                       qc=qc)
+    gates,rays = _station_indices(radar, lons, lats, sweep=sweep)
+
+    range_km,_ = lat_lon_to_range_azimuth(lats, lons, radar=radar)
+    covered = _stations_in_range(radar, lons, lats, gates, sweep)
+
+    height = np.asarray(radar.gate_altitude['data'][rays, gates], dtype=np.float64)
+
+    if qc_score:
+        ray_idx,gate_idx = _window_indices(radar, gates, rays, window)
+        invalid = qc_mask(radar, ray_idx, gate_idx,
+                          rhohv_field=rhohv_field,
+                          rhohv_threshold=rhohv_threshold,
+                          **qc)
+        score = 1. - invalid.reshape(len(lats), -1).mean(axis=1)
+    else:
+        score = np.full(len(lats), np.nan)
+
+    return {'site': _site_name(radar),
+            'path': path,
+            'fecha': fecha,
+            'values': values,
+            'range_km': np.asarray(range_km, dtype=np.float64),
+            'height': height,
+            'qc': score,
+            'covered': covered}
+
+
+
+class RadarWindowAccumulator:
+    """
+    Acumulador columnar de las ventanas NxN extraidas volumen a volumen. Reemplaza el
+    armado de un DataFrame de una fila por volumen (create_df_from_radar_windows_vars)
+    y el pd.concat final: cada volumen se copia en buffers de NumPy preasignados
+    (tiempo x estacion x campo x celda) que crecen al doble cuando se llenan, y el
+    DataFrame se arma una sola vez al final (o por bloques con flush).
+    Las celdas enmascaradas quedan como NaN en el DataFrame.
+
+    Parameters:
+              stations (list): Nombres de las estaciones, en el mismo orden de las filas
+                               del array de radar_variable_window_lat_lon_array.
+              fields (str o list): Nombres de los campos, en el mismo orden que al extraer.
+              window (int): Tamaño N de la ventana NxN. Default 3.
+              capacity (int): Cantidad inicial de volumenes de los buffers. Default 256.
+    """
+
+    def __init__(self, stations, fields, window=3, capacity=256):
+        if isinstance(fields, str):
+            fields = [fields]
+        self.stations = list(stations)
+        self.fields = list(fields)
+        self.window = window
+        self._n = 0
+        self._allocate(max(int(capacity), 1))
+
+    def _allocate(self, capacity):
+        shape = (capacity, len(self.stations), len(self.fields), self.window, self.window)
+        self._times = np.empty(capacity, dtype='datetime64[ns]')
+        self._values = np.empty(shape, dtype=np.float32)
+        self._mask = np.empty(shape, dtype=bool)
+
+    def __len__(self):
+        return self._n
+
+    def append(self, fecha, values):
+        """
+        Agrega un volumen al acumulador.
+
+        Parameters:
+                  fecha (datetime obj): Fecha y hora del volumen. Si values es el dict de
+                                        radar_variable_window_lat_lon_list puede ser None y
+                                        se usa su clave 'datetime'.
+                  values (masked array o dict): Array (estaciones, campos, N, N) de
+                                        radar_variable_window_lat_lon_array o dict de
+                                        radar_variable_window_lat_lon_list.
+        """
+        fecha,values = _windows_from_result(fecha, values, self.stations)
+        expected = self._values.shape[1:]
+        if values.shape != expected:
+            raise ValueError('Las dimensiones de values %s no coinciden con %s' % (values.shape, expected))
+
+        if self._n == self._times.shape[0]:
+            # Buffers llenos: duplico la capacidad y copio lo acumulado
+            times,data,mask = self._times,self._values,self._mask
+            self._allocate(2*self._n)
+            self._times[:self._n] = times
+            self._values[:self._n] = data
+            self._mask[:self._n] = mask
+
+        self._times[self._n] = np.datetime64(fecha, 'ns')
+        self._values[self._n] = np.ma.getdata(values)
+        self._mask[self._n] = np.ma.getmaskarray(values)
+        self._n += 1
+
+    def to_dataframe(self, flat=False):
+        """
+        Arma el DataFrame con todo lo acumulado. Las filas tienen un MultiIndex
+        (estacion, t radar[ART]) y las columnas un MultiIndex (campo, i, j) o, si flat es
+        True, los mismos nombres de create_df_from_radar_windows_vars ('DBZH [0,0]', ...).
+
+        Parameters:
+                  flat (bool): True para usar nombres de columnas planos. Default False.
+
+        Returns:
+                  df (DataFrame): DataFrame de Pandas con los resultados.
+        """
+        n = self._n
+        n_stations = len(self.stations)
+        with _stage('dataframe'):
+            # (tiempo, estacion, ...) -> (estacion, tiempo, campo*N*N)
+            values = np.where(self._mask[:n], np.nan, self._values[:n])
+            values = values.swapaxes(0, 1).reshape(n_stations*n, -1)
+
+            index = pd.MultiIndex.from_product([self.stations, pd.DatetimeIndex(self._times[:n])],
+                                               names=['estacion', 't radar[ART]'])
+            if flat:
+                columns = _window_column_names(self.fields, self.window)
+            else:
+                columns = pd.MultiIndex.from_product([self.fields, range(self.window), range(self.window)],
+                                                     names=['campo', 'i', 'j'])
+            return pd.DataFrame(values, index=index, columns=columns)
+
+    def flush(self, flat=False):
+        """
+        Devuelve el DataFrame de lo acumulado (ver to_dataframe) y vacia el acumulador
+        conservando los buffers para el siguiente bloque.
+        """
+        df = self.to_dataframe(flat=flat)
+        self._n = 0
+        return df
+
+
+
+def _windows_from_result(fecha, values, stations):
+    """
+    Normaliza la salida de los extractores a (fecha, masked array (estaciones, campos, N, N)).
+    values puede ser el array de radar_variable_window_lat_lon_array o el dict de
+    radar_variable_window_lat_lon_list (de donde se toma la fecha si fecha es None).
+    """
+    if isinstance(values, dict):
+        if fecha is None:
+            fecha = values['datetime']
+        values = np.ma.stack([np.ma.stack([np.ma.asarray(w, dtype=np.float32) for w in values[name]])
+                              for name in stations])
+    return fecha,np.ma.asarray(values)
+
+
+
+class StationWindowStore:
+    """
+    Almacen persistente de las ventanas NxN extraidas sobre estaciones, con ejes
+    tiempo x estacion x campo x N x N. Los datos se guardan en un directorio, en bloques
+    de chunk_size volumenes (archivos .npy con los valores float32, la mascara y las
+    fechas) que se abren como memory-map, de modo que leer un rango de fechas o algunas
+    estaciones no carga todo el cubo en memoria. meta.json guarda las estaciones, los
+    campos, el tamaño de ventana y el rango de fechas de cada bloque.
+
+    Parameters:
+              path (str): Directorio del almacen. Si ya existe se abre.
+              stations (list): Nombres de las estaciones (necesario para crear el almacen).
+              fields (str o list): Nombres de los campos (necesario para crear el almacen).
+              window (int): Tamaño N de la ventana NxN. Al abrir un almacen existente debe
+                            coincidir con el guardado; None lo toma del almacen. Default
+                            None (3 al crear el almacen).
+              chunk_size (int): Cantidad de volumenes por bloque. Default 1024.
+              mode (str): 'a' para leer y agregar, 'r' solo lectura. Default 'a'.
+    """
+
+    def __init__(self, path, stations=None, fields=None, window=None, chunk_size=1024, mode='a'):
+        if mode not in ('a', 'r'):
+            raise ValueError("mode debe ser 'a' o 'r'")
+        self.path = path
+        self.mode = mode
+        self._chunks = {}
+        meta_path = os.path.join(path, 'meta.json')
+
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self._meta = json.load(f)
+            if isinstance(fields, str):
+                fields = [fields]
+            if (stations is not None and list(stations) != self._meta['stations']) or \
+               (fields is not None and list(fields) != self._meta['fields']) or \
+               (window is not None and int(window) != self._meta['window']):
+                raise ValueError('Las estaciones, campos o ventana no coinciden con los del almacen '+path)
+        else:
+            if mode == 'r':
+                raise FileNotFoundError('No existe el almacen '+path)
+            if stations is None or fields is None:
+                raise ValueError('Para crear el almacen se necesitan stations y fields')
+            if isinstance(fields, str):
+                fields = [fields]
+            os.makedirs(path, exist_ok=True)
+            self._meta = {'stations': list(stations),
+                          'fields': list(fields),
+                          'window': 3 if window is None else int(window),
+                          'chunk_size': int(chunk_size),
+                          'count': 0,
+                          'chunk_bounds': []}
+            self._write_meta()
+
+    @property
+    def stations(self):
+        return list(self._meta['stations'])
+
+    @property
+    def fields(self):
+        return list(self._meta['fields'])
+
+    @property
+    def window(self):
+        return self._meta['window']
+
+    def __len__(self):
+        return self._meta['count']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write_meta(self):
+        # Escritura atomica para no dejar un meta.json a medias
+        tmp_path = os.path.join(self.path, 'meta.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self._meta, f)
+        os.replace(tmp_path, os.path.join(self.path, 'meta.json'))
+
+    def _chunk(self, k, create=False):
+        """Memory-maps (times, values, mask) del bloque k."""
+        if k in self._chunks:
+            return self._chunks[k]
+        names = [os.path.join(self.path, '%s_%05d.npy' % (name, k)) for name in ('times', 'values', 'mask')]
+        if create and not os.path.exists(names[0]):
+            n = self._meta['chunk_size']
+            shape = (n, len(self._meta['stations']), len(self._meta['fields']), self.window, self.window)
+            times = np.lib.format.open_memmap(names[0], mode='w+', dtype=np.int64, shape=(n,))
+            times[:] = np.iinfo(np.int64).min  # NaT
+            chunk = (times,
+                     np.lib.format.open_memmap(names[1], mode='w+', dtype=np.float32, shape=shape),
+                     np.lib.format.open_memmap(names[2], mode='w+', dtype=bool, shape=shape))
+        else:
+            mmap_mode = 'r' if self.mode == 'r' else 'r+'
+            chunk = tuple(np.load(name, mmap_mode=mmap_mode) for name in names)
+        self._chunks[k] = chunk
+        return chunk
+
+    def append(self, fecha, values):
+        """
+        Agrega un volumen al almacen.
+
+        Parameters:
+                  fecha (datetime obj): Fecha y hora del volumen (None si values es el dict de
+                                        radar_variable_window_lat_lon_list).
+                  values (masked array o dict): Array (estaciones, campos, N, N) de
+                                        radar_variable_window_lat_lon_array o dict de
+                                        radar_variable_window_lat_lon_list.
+        """
+        if self.mode == 'r':
+            raise ValueError('El almacen esta abierto en modo solo lectura')
+        fecha,values = _windows_from_result(fecha, values, self._meta['stations'])
+        shape = (len(self._meta['stations']), len(self._meta['fields']), self.window, self.window)
+        if values.shape != shape:
+            raise ValueError('Las dimensiones de values %s no coinciden con %s' % (values.shape, shape))
+
+        k,row = divmod(self._meta['count'], self._meta['chunk_size'])
+        times,data,mask = self._chunk(k, create=True)
+        t = np.datetime64(fecha, 'ns').astype(np.int64)
+        data[row] = np.ma.getdata(values)
+        mask[row] = np.ma.getmaskarray(values)
+        times[row] = t
+
+        # Rango de fechas de cada bloque para saltear bloques al leer
+        bounds = self._meta['chunk_bounds']
+        if k == len(bounds):
+            bounds.append([int(t), int(t)])
+        else:
+            bounds[k] = [min(bounds[k][0], int(t)), max(bounds[k][1], int(t))]
+        self._meta['count'] += 1
+        self._write_meta()
+
+    def read(self, start=None, end=None, stations=None, fields=None):
+        """
+        Lee un rango de fechas y un subconjunto de estaciones/campos. Solo se leen del
+        disco los bloques cuyo rango de fechas se superpone con [start, end].
+
+        Parameters:
+                  start (datetime): Fecha/hora inicial (inclusive). Default None.
+                  end (datetime): Fecha/hora final (inclusive). Default None.
+                  stations (list): Estaciones a leer. None para todas. Default None.
+                  fields (str o list): Campos a leer. None para todos. Default None.
+
+        Returns:
+                  times (array datetime64): Fechas de los volumenes leidos, en orden.
+                  values (masked array): Array (tiempo, estaciones, campos, N, N).
+        """
+        t0 = np.iinfo(np.int64).min + 1 if start is None else pd.Timestamp(start).value
+        t1 = np.iinfo(np.int64).max if end is None else pd.Timestamp(end).value
+        if isinstance(fields, str):
+            fields = [fields]
+        s_idx = np.arange(len(self._meta['stations'])) if stations is None else \
+                np.array([self._meta['stations'].index(s) for s in stations], dtype=int)
+        f_idx = np.arange(len(self._meta['fields'])) if fields is None else \
+                np.array([self._meta['fields'].index(f) for f in fields], dtype=int)
+
+        times_out,data_out,mask_out = [],[],[]
+        for k,(lo,hi) in enumerate(self._meta['chunk_bounds']):
+            if hi < t0 or lo > t1:
+                continue
+            n = min(self._meta['chunk_size'], self._meta['count'] - k*self._meta['chunk_size'])
+            times,data,mask = self._chunk(k)
+            rows = np.nonzero((times[:n] >= t0) & (times[:n] <= t1))[0]
+            if rows.size == 0:
+                continue
+            # Solo se copian de disco las filas, estaciones y campos pedidos
+            times_out.append(np.asarray(times[rows]))
+            data_out.append(data[np.ix_(rows, s_idx, f_idx)])
+            mask_out.append(mask[np.ix_(rows, s_idx, f_idx)])
+
+        shape = (0, len(s_idx), len(f_idx), self.window, self.window)
+        if not times_out:
+            return np.array([], dtype='datetime64[ns]'),np.ma.masked_all(shape, dtype=np.float32)
+
+        times = np.concatenate(times_out)
+        order = np.argsort(times, kind='stable')
+        values = np.ma.masked_array(np.concatenate(data_out)[order], mask=np.concatenate(mask_out)[order])
+        return times[order].astype('datetime64[ns]'),values
+
+    def contains(self, fecha):
+        """True si el almacen ya tiene un volumen con la fecha/hora fecha."""
+        t = pd.Timestamp(fecha).value
+        for k,(lo,hi) in enumerate(self._meta['chunk_bounds']):
+            if lo <= t <= hi:
+                n = min(self._meta['chunk_size'], self._meta['count'] - k*self._meta['chunk_size'])
+                if np.any(self._chunk(k)[0][:n] == t):
+                    return True
+        return False
+
+    def close(self):
+        """Escribe a disco los bloques abiertos y los cierra."""
+        for chunk in self._chunks.values():
+            for array in chunk:
+                if isinstance(array, np.memmap) and self.mode != 'r':
+                    array.flush()
+        self._chunks.clear()
+
+
+
+_WATCH_CHECKPOINT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS processed (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    datetime TEXT,
+    status TEXT,
+    processed_at TEXT,
+    seconds REAL,
+    latency REAL
+);
+"""
+
+
+
+def watch_radar_folder(folder,
+                       stations,
+                       fields,
+                       checkpoint_db,
+                       store=None,
+                       callback=None,
+                       pattern='*',
+                       recursive=False,
+                       poll_interval=2.,
+                       stable_time=2.,
+                       name_col='estacion',
+                       lat_col='lat',
+                       lon_col='lon',
+                       rhohv_field='RHOHV',
+                       rhohv_threshold=0.8,
+                       mask=False,
+                       sweep=0,
+                       window=3,
+                       qc=None,
+                       max_retries=3,
+                       max_volumes=None,
+                       timeout=None,
+                       verbose=False):
+    """
+    Funcion para procesar en tiempo casi real los volumenes que llegan a un directorio.
+    El directorio se consulta cada poll_interval segundos y cada volumen nuevo se procesa
+    con radar_variable_window_lat_lon_list una sola vez: los archivos terminados (con su
+    tamaño y fecha de modificacion) se registran en una base SQLite (checkpoint_db), de
+    modo que al reiniciar se saltean. Un archivo se considera completo cuando no se
+    modifico en los ultimos stable_time segundos (si el volumen se copia con otro nombre
+    y despues se renombra, alcanza con stable_time=0).
+    Los resultados se agregan a un StationWindowStore (sin duplicar fechas que ya esten
+    en el almacen) y/o se pasan a callback(path, result). Para cada volumen se informa
+    la latencia de punta a punta: desde la ultima modificacion del archivo hasta que se
+    termino de guardar el resultado. Tambien queda registrada en checkpoint_db y, con la
+    instrumentacion activa, en la etapa 'end_to_end'.
+    Los volumenes que no se pueden procesar se registran con status 'error' pero no se
+    dan por terminados: se reintentan en las consultas siguientes (por ejemplo ante un
+    error transitorio de lectura de un disco de red) hasta max_retries veces, y luego
+    solo si el archivo cambia o al reiniciar. Solo los volumenes con status 'ok' se
+    saltean al reiniciar.
+    La funcion termina con max_volumes, timeout o Ctrl+C.
+    Parameters:
+            folder (str): Directorio a vigilar.
+            stations (DataFrame): Tabla de estaciones con nombre, latitud y longitud.
+            fields (str o list): Nombres de los campos de radar a extraer.
+            checkpoint_db (str): Path a la base SQLite con los archivos procesados.
+            store (StationWindowStore o str): Almacen (o su directorio) donde agregar los
+                                              resultados. Default None.
+            callback (callable): Funcion callback(path, result) llamada con el dict de
+                                 radar_variable_window_lat_lon_list. Default None.
+            pattern (str): Patron glob de los archivos dentro de folder. Default '*'.
+            recursive (bool): True para vigilar tambien los subdirectorios. Default False.
+            poll_interval (float): Segundos entre consultas al directorio. Default 2.
+            stable_time (float): Segundos sin modificaciones para considerar completo un
+                                 archivo. Default 2.
+            name_col (str): Columna de stations con el nombre. Default 'estacion'.
+            lat_col (str): Columna de stations con la latitud. Default 'lat'.
+            lon_col (str): Columna de stations con la longitud. Default 'lon'.
+            rhohv_field (str): Nombre del campo RHOHV. Default 'RHOHV'.
+            rhohv_threshold (float): Valor de RHOHV (0 a 1) para aplicar mascara. Default 0.8.
+            mask (bool): True para aplicar mascara. Default False.
+            sweep (int): Numero de barrido a leer. Default 0.
+            window (int): Tamaño N (impar) de la ventana NxN. Default 3.
+            qc (dict): Criterios adicionales de control de calidad para mask=True (ver
+                       qc_mask). Default None.
+            max_retries (int): Cantidad maxima de intentos de un volumen con error en
+                               esta ejecucion. Default 3.
+            max_volumes (int): Cantidad de volumenes a procesar antes de terminar. None
+                               para no limitar. Default None.
+            timeout (float): Segundos de ejecucion antes de terminar. None para no
+                             limitar. Default None.
+            verbose (bool): True para obtener los print de pantalla. Default False.
+
+    Returns:
+            n_processed (int): Cantidad de volumenes procesados en esta ejecucion.
+    """
+    if isinstance(fields, str):
+        fields = [fields]
+    names = list(stations[name_col])
+    lats = np.asarray(stations[lat_col], dtype=float)
+    lons = np.asarray(stations[lon_col], dtype=float)
+
+    own_store = isinstance(store, str)
+    if own_store:
+        store = StationWindowStore(store, names, fields, window=window)
+
+    if recursive:
+        pattern = os.path.join(folder, '**', pattern)
+    else:
+        pattern = os.path.join(folder, pattern)
+
+    n_processed = 0
+    t_start = time.time()
+    # Importo pyart antes de la primera consulta para que su carga no se sume a la
+    # latencia del primer volumen (el proxy perezoso luego lo toma de sys.modules)
+    importlib.import_module('pyart')
+
+    with closing(sqlite3.connect(checkpoint_db)) as conn:
+        conn.executescript(_WATCH_CHECKPOINT_SCHEMA)
+        done = {row[0]: (row[1], row[2]) for row in
+                conn.execute("SELECT path, size, mtime FROM processed WHERE status = 'ok'")}
+        # Volumenes con error: path -> (tamaño, fecha de modificacion, intentos)
+        failed = {}
+        try:
+            while True:
+                # Archivos nuevos (o modificados) y completos, en orden de llegada
+                now = time.time()
+                ready = []
+                for path in glob.glob(pattern, recursive=recursive):
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    if not os.path.isfile(path) or done.get(path) == (stat.st_size, stat.st_mtime):
+                        continue
+                    if failed.get(path, (None, None, 0))[:2] == (stat.st_size, stat.st_mtime) and \
+                       failed[path][2] >= max_retries:
+                        continue
+                    if now - stat.st_mtime >= stable_time:
+                        ready.append((stat.st_mtime, path, stat.st_size))
+
+                for mtime,path,size in sorted(ready):
+                    status,fecha,seconds,latency = _watch_process_volume(path, mtime, names, lats, lons,
+                                                                         fields, store, callback,
+                                                                         rhohv_field, rhohv_threshold,
+                                                                         mask, sweep, window, qc)
+                    conn.execute('INSERT OR REPLACE INTO processed VALUES (?,?,?,?,?,?,?,?)',
+                                 (path, size, mtime,
+                                  fecha.strftime('%Y-%m-%dT%H:%M:%S') if fecha is not None else None,
+                                  status, datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+                                  seconds, latency))
+                    conn.commit()
+                    if status == 'ok':
+                        done[path] = (size, mtime)
+                        failed.pop(path, None)
+                    else:
+                        attempts = failed.get(path, (None, None, 0))
+                        attempts = attempts[2] + 1 if attempts[:2] == (size, mtime) else 1
+                        failed[path] = (size, mtime, attempts)
+                    n_processed += 1
+                    if verbose:
+                        print('Procesado %s (%s): %.2f s de proceso, %.2f s de latencia'
+                              % (path, status, seconds, latency))
+                    if max_volumes is not None and n_processed >= max_volumes:
+                        return n_processed
+
+                if timeout is not None and time.time() - t_start >= timeout:
+                    break
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            if verbose:
+                print('Interrumpido. Volumenes procesados:', n_processed)
+        finally:
+            if own_store:
+                store.close()
+
+    return n_processed
+
+
+
+def _watch_process_volume(path, mtime, names, lats, lons, fields, store, callback,
+                          rhohv_field, rhohv_threshold, mask, sweep, window, qc):
+    """
+    Procesa un volumen de watch_radar_folder. Devuelve el status ('ok' o 'error'), la
+    fecha del volumen, los segundos de proceso y la latencia desde la llegada del archivo.
+    """
+    t0 = time.time()
+    fecha = None
+    try:
+        result = radar_variable_window_lat_lon_list(path, fields, names, lats, lons,
+                                                    rhohv_field=rhohv_field,
+                                                    rhohv_threshold=rhohv_threshold,
+                                                    mask=mask,
+                                                    sweep=sweep,
+                                                    window=window,
+                                                    qc=qc)
+        fecha = result['datetime']
+        # Si se corto entre el guardado y el checkpoint, el volumen ya esta en el almacen
+        if store is not None and not store.contains(fecha):
+            store.append(None, result)
+        if callback is not None:
+            callback(path, result)
+        status = 'ok'
+    except Exception as error:
+        print('Error al procesar el volumen', path, ':', error)
+        status = 'error'
+
+    t1 = time.time()
+    latency = t1 - mtime
+    if _METRICS is not None:
+        _METRICS.timing('end_to_end', latency)
+    return status,fecha,t1 - t0,latency
+
+
+
+_VOLUME_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS volumes (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    datetime TEXT,
+    site TEXT,
+    n_sweeps INTEGER,
+    fixed_angles TEXT,
+    n_rays INTEGER,
+    n_gates INTEGER,
+    fields TEXT,
+    fingerprint TEXT
+);
+CREATE INDEX IF NOT EXISTS volumes_datetime ON volumes (datetime);
+CREATE INDEX IF NOT EXISTS volumes_site_datetime ON volumes (site, datetime);
+"""
+
+
+
+def build_volume_index(archive, db_path, prune=False, verbose=False):
+    """
+    Funcion para indexar un archivo de volumenes de radar en una base SQLite local sin
+    decodificar los campos. De cada volumen se guarda: fecha/hora (radar.time['units']),
+    sitio, cantidad de barridos y sus elevaciones, cantidad de rayos y gates, lista de
+    campos, huella de la geometria (geometry_fingerprint) y tamaño del archivo.
+    La actualizacion es incremental: solo se leen los archivos nuevos o modificados
+    (distinto tamaño o fecha de modificacion). Los archivos CF/Radial se leen con
+    delay_field_loading, por lo que solo se leen los encabezados y las coordenadas.
+    Los paths se guardan absolutos, asi un mismo volumen tiene una sola entrada.
+    Parameters:
+            archive (str o list): Directorio (se recorre con sus subdirectorios), patron glob
+                                  o lista de paths a los volumenes.
+            db_path (str): Path a la base SQLite (se crea si no existe).
+            prune (bool): True para borrar del indice los archivos que ya no estan en archive.
+                          Default False.
+            verbose (bool): True para obtener los print de pantalla. Default False.
+
+    Returns:
+            n_indexed (int): Cantidad de volumenes agregados o actualizados.
+    """
+    paths = [os.path.abspath(path) for path in _list_volumes(archive, recursive=True)]
+    n_indexed = 0
+
+    with closing(sqlite3.connect(db_path)) as conn:
+        conn.executescript(_VOLUME_INDEX_SCHEMA)
+        known = {row[0]: (row[1], row[2]) for row in
+                 conn.execute('SELECT path, size, mtime FROM volumes')}
+
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # Se borro o movio despues de listarlo
+                continue
+            if known.get(path) == (stat.st_size, stat.st_mtime):
+                continue
+            try:
+                header = _read_volume_header(path)
+            except Exception as error:
+                print('Error al leer el encabezado de', path, ':', error)
+                continue
+
+            conn.execute('INSERT OR REPLACE INTO volumes VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+                         (path, stat.st_size, stat.st_mtime) + header)
+            n_indexed += 1
+            if verbose:
+                print('Indexado', path)
+            # Confirmo por bloques para no perder mucho trabajo si se corta
+            if n_indexed % 500 == 0:
+                conn.commit()
+
+        if prune:
+            missing = set(known) - set(paths)
+            conn.executemany('DELETE FROM volumes WHERE path = ?', [(p,) for p in missing])
+        conn.commit()
+
+    return n_indexed
+
+
+
+def _read_volume_header(path):
+    """
+    Lee los metadatos de un volumen para build_volume_index. Devuelve la tupla de
+    columnas (datetime, site, n_sweeps, fixed_angles, n_rays, n_gates, fields, fingerprint).
+    """
+    if pyart.io.auto_read.determine_filetype(path) in ('NETCDF3', 'NETCDF4'):
+        # CF/Radial: los campos quedan sin leer hasta que se accede a ellos
+        radar = pyart.io.read(path, delay_field_loading=True)
+    else:
+        radar = pyart.io.read(path)
+
+    return (radar_datetime(radar).strftime('%Y-%m-%dT%H:%M:%S'),
+            _site_name(radar),
+            int(radar.nsweeps),
+            json.dumps([round(float(a), 2) for a in radar.fixed_angle['data']]),
+            int(radar.nrays),
+            int(radar.ngates),
+            json.dumps(sorted(radar.fields)),
+            geometry_fingerprint(radar))
+
+
+
+def _site_name(radar, max_distance_km=2.):
+    """
+    Nombre del sitio del radar: instrument_name si esta en RADAR_SITES, si no el sitio
+    de RADAR_SITES a menos de max_distance_km, y si no instrument_name (o None).
+    """
+    name = radar.metadata.get('instrument_name')
+    if isinstance(name, bytes):
+        name = name.decode()
+    if name is not None and str(name).upper() in RADAR_SITES:
+        return str(name).upper()
+
+    names = list(RADAR_SITES)
+    lats = np.array([RADAR_SITES[n][0] for n in names])
+    lons = np.array([RADAR_SITES[n][1] for n in names])
+    distance,_ = lat_lon_to_range_azimuth(lats, lons, radar=radar)
+    if distance.min() <= max_distance_km:
+        return names[int(np.argmin(distance))]
+    return None if name is None else str(name)
+
+
+
+def query_volume_index(db_path, start=None, end=None, site=None, fingerprint=None, as_frame=False):
+    """
+    Funcion para seleccionar volumenes del indice de build_volume_index por rango de
+    fechas, sitio y/o geometria, con una consulta indexada (sin listar ni leer directorios).
+    Parameters:
+            db_path (str): Path a la base SQLite.
+            start (datetime): Fecha/hora inicial (inclusive). Default None.
+            end (datetime): Fecha/hora final (inclusive). Default None.
+            site (str): Sitio del radar (ej. 'RMA1'). Default None.
+            fingerprint (str): Huella de geometria (geometry_fingerprint). Default None.
+            as_frame (bool): True para devolver un DataFrame con todas las columnas del
+                             indice. Default False.
+
+    Returns:
+            paths (list o DataFrame): Paths de los volumenes ordenados por fecha/hora
+                                      (o DataFrame si as_frame es True).
+    """
+    conditions = []
+    params = []
+    if start is not None:
+        conditions.append('datetime >= ?')
+        params.append(pd.Timestamp(start).strftime('%Y-%m-%dT%H:%M:%S'))
+    if end is not None:
+        conditions.append('datetime <= ?')
+        params.append(pd.Timestamp(end).strftime('%Y-%m-%dT%H:%M:%S'))
+    if site is not None:
+        conditions.append('site = ?')
+        params.append(site)
+    if fingerprint is not None:
+        conditions.append('fingerprint = ?')
+        params.append(fingerprint)
+
+    query = 'SELECT * FROM volumes'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY datetime, path'
+
+    with closing(sqlite3.connect(db_path)) as conn:
+        if as_frame:
+            return pd.read_sql_query(query, conn, params=params, parse_dates=['datetime'])
+        return [row[0] for row in conn.execute(query, params)]
+
+
+
+def db_to_linear(in_df):
+    """
+    Funcion para transformar los valores de las columnas de dB
+    a unidades lineales: La operacion que se realiza es la siguiente:
+    
+                   linear_value = 10**(db_value / 10)
+    Parameters: 
+              in_df (DataFrame): DataFrame de entrada con los valores en db
+    
+    Return:
+              out_df (DataFrame): DataFrame de salida en unidades lineales
+    """
+    
+    return 10**(in_df/10)
+
+
+
+def linear_to_db(in_df):
     """
     Funcion para transformar los valores de las columnas de unidades lineales
     a dB: La operacion que se realiza es la siguiente:
@@ -471,42 +2555,234 @@ def linear_to_db(in_df):
 
 
 
-def lat_lon_to_range_azimuth(lat,lon):
+def read_raw_field(radarfilepath, field):
+    """
+    Funcion para leer un campo de un volumen CF/Radial (netCDF) sin decodificar: los
+    valores enteros tal como estan guardados (8 o 16 bits), con su escala, desplazamiento
+    y valor de relleno, para convertirlos con las tablas de db_to_linear_lut,
+    linear_to_db_lut o rain_rate_lut. Requiere netCDF4.
+    Parameters:
+            radarfilepath (str): Path al archivo volumen de radar (CF/Radial).
+            field (str): Nombre del campo.
+
+    Returns:
+            raw (dict): Dict con 'data' (array de enteros (nrays, ngates)), 'scale_factor',
+                        'add_offset' y '_FillValue' (None si el campo no los tiene).
+    """
+    import netCDF4
+
+    with netCDF4.Dataset(radarfilepath) as dataset:
+        try:
+            variable = dataset.variables[field]
+        except KeyError:
+            print('Error. Campo no encontrado. Los campos disponibles son:',dataset.variables.keys())
+            raise
+        variable.set_auto_maskandscale(False)
+        attrs = variable.ncattrs()
+        return {'data': variable[:],
+                'scale_factor': float(variable.scale_factor) if 'scale_factor' in attrs else 1.,
+                'add_offset': float(variable.add_offset) if 'add_offset' in attrs else 0.,
+                '_FillValue': variable.getncattr('_FillValue') if '_FillValue' in attrs else None}
+
+
+
+@functools.lru_cache(maxsize=64)
+def _moment_lut(scale, offset, nbits, signed, kind, coefficients=None):
+    """
+    Tabla (float32, solo lectura) con el valor convertido de cada codigo entero posible
+    de nbits bits: fisico = codigo*scale + offset y luego, segun kind, 'linear'
+    (10**(x/10)), 'db' (10*log10(x)) o 'rain_rate' (Z-R con coefficients = (a, b)).
+    Se guarda en cache por (scale, offset, nbits, signed, kind, coefficients).
+    """
+    codes = np.arange(2**nbits, dtype=np.int64)
+    if signed:
+        codes = np.where(codes >= 2**(nbits-1), codes - 2**nbits, codes)
+    values = codes*scale + offset
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        if kind == 'linear':
+            lut = db_to_linear(values)
+        elif kind == 'db':
+            lut = linear_to_db(values)
+        else:
+            a,b = coefficients
+            lut = calculate_R_from_Z_R(a, b, db_to_linear(values))
+    lut = lut.astype(np.float32)
+    lut.flags.writeable = False
+    return lut
+
+
+
+def _apply_moment_lut(raw, kind, scale, offset, fill_value, coefficients=None):
+    """
+    Convierte un array de codigos enteros con la tabla de _moment_lut (un solo indexado).
+    Se enmascaran los codigos iguales a fill_value, los ya enmascarados y los resultados
+    no finitos.
+    """
+    data = np.asarray(np.ma.getdata(raw))
+    if data.dtype.kind not in 'iu' or data.dtype.itemsize > 2:
+        raise ValueError('Las tablas solo se aplican a enteros de 8 o 16 bits (dtype %s)' % data.dtype)
+
+    lut = _moment_lut(float(scale), float(offset), data.dtype.itemsize*8, data.dtype.kind == 'i',
+                      kind, coefficients)
+    # Los codigos con signo se leen como sin signo para indexar la tabla
+    codes = data.view(np.dtype('u%d' % data.dtype.itemsize))
+    out = np.take(lut, codes)
+
+    mask = np.ma.getmaskarray(raw) | ~np.isfinite(out)
+    if fill_value is not None:
+        mask |= data == fill_value
+    return np.ma.masked_array(out, mask=mask)
+
+
+
+def db_to_linear_lut(raw, scale=1., offset=0., fill_value=None):
+    """
+    Funcion equivalente a db_to_linear para momentos cuantizados (enteros de 8 o 16 bits
+    con valor = raw*scale + offset): en lugar de calcular 10**(x/10) en cada gate se usa
+    una tabla precalculada (en cache) con el resultado de cada codigo posible. Se puede
+    aplicar a un campo entero o a gates ya extraidos (ej. raw[rays, gates]).
+    Parameters:
+              raw (array de enteros): Codigos en dB (ej. read_raw_field(path, 'DBZH')['data']).
+              scale (float): Escala (scale_factor). Default 1.
+              offset (float): Desplazamiento (add_offset). Default 0.
+              fill_value (int): Codigo de dato faltante (_FillValue). Default None.
+    Return:
+              out (masked array): Valores en unidades lineales (float32).
+    """
+    return _apply_moment_lut(raw, 'linear', scale, offset, fill_value)
+
+
+
+def linear_to_db_lut(raw, scale=1., offset=0., fill_value=None):
+    """
+    Funcion equivalente a linear_to_db para momentos cuantizados en unidades lineales
+    (enteros de 8 o 16 bits con valor = raw*scale + offset), con una tabla precalculada.
+    Parameters:
+              raw (array de enteros): Codigos en unidades lineales.
+              scale (float): Escala (scale_factor). Default 1.
+              offset (float): Desplazamiento (add_offset). Default 0.
+              fill_value (int): Codigo de dato faltante (_FillValue). Default None.
+    Return:
+              out (masked array): Valores en dB (float32). Los valores <= 0 quedan enmascarados.
+    """
+    return _apply_moment_lut(raw, 'db', scale, offset, fill_value)
+
+
+
+def rain_rate_lut(raw, coefficients, scale=1., offset=0., fill_value=None):
     """
-    Funcion para calcular el rango y el azimuth de un punto con coordenadas
-    lat y lon teniendo como referencia la ubicacion del radar RMA1.
+    Funcion para calcular la tasa de precipitacion con la relacion Z-R directamente a
+    partir de la reflectividad cuantizada (enteros de 8 o 16 bits en dBZ): la conversion
+    dBZ -> Z y la relacion R = (Z/a)**(1/b) se combinan en una sola tabla, asi que el
+    calculo cuesta un indexado por gate:
+
+        raw = read_raw_field(path, 'DBZH')
+        R = rain_rate_lut(raw['data'], (300, 1.4), raw['scale_factor'], raw['add_offset'],
+                          raw['_FillValue'])
+
     Parameters:
-               lat (float): Latitud en grados decimales.
-               lon (float): Longitud en grados decimales.
+               raw (array de enteros): Codigos de reflectividad.
+               coefficients (tuple): Parametros (a, b) de la relacion Z-R.
+               scale (float): Escala (scale_factor). Default 1.
+               offset (float): Desplazamiento (add_offset). Default 0.
+               fill_value (int): Codigo de dato faltante (_FillValue). Default None.
     Return:
-            distance (float): Distancia al radar en km (rango).
-            azimuth (float): Azimuth del punto ingresado en grados. Medido en sentido
-                             horario con el 0 en el norte geográfico.
+               R (masked array): Tasa de precipitacion (float32).
     """
+    a,b = coefficients
+    return _apply_moment_lut(raw, 'rain_rate', scale, offset, fill_value, (float(a), float(b)))
+
+
+
+# Ubicacion (latitud, longitud) de los radares RMA del SiNaRaMe.
+# Solo RMA1 esta verificado contra los metadatos de los volumenes; el resto son
+# coordenadas nominales de los sitios. Si se dispone del volumen conviene pasar el
+# objeto radar a lat_lon_to_range_azimuth para usar la ubicacion exacta.
+RADAR_SITES = {'RMA1': (-31.4412824015, -64.1919061484),  # Cordoba
+               'RMA2': (-34.8017, -58.5156),              # Ezeiza, Buenos Aires
+               'RMA3': (-24.7306, -60.5522),              # Las Lomitas, Formosa
+               'RMA4': (-27.4517, -59.0508),              # Resistencia, Chaco
+               'RMA5': (-26.2778, -53.6711),              # Bernardo de Irigoyen, Misiones
+               'RMA6': (-37.9122, -57.5281),              # Mar del Plata, Buenos Aires
+               'RMA7': (-38.8767, -68.1447),              # Neuquen
+               'RMA8': (-29.2006, -58.0444),              # Mercedes, Corrientes
+               'RMA9': (-53.7867, -67.7508),              # Rio Grande, Tierra del Fuego
+               'RMA10': (-38.7333, -62.1639),             # Espora, Bahia Blanca
+               'RMA11': (-27.5036, -64.9053)}             # Termas de Rio Hondo, Santiago del Estero
+
+# Geodesica WGS84 compartida (se crea la primera vez que se usa)
+_GEOD = None
+
+
+
+def _get_geod():
+    """
+    Devuelve la geodesica WGS84 del modulo, creandola en el primer uso.
+    """
+    global _GEOD
+    if _GEOD is None:
+        import pyproj
+        _GEOD = pyproj.Geod(ellps='WGS84')
+    return _GEOD
+
+
+
+def _radar_site(radar=None, site='RMA1'):
+    """
+    Latitud y longitud del radar: del objeto radar si se indica, si no del registro
+    RADAR_SITES (por nombre) o de una tupla (lat, lon).
+    """
+    if radar is not None:
+        return float(radar.latitude['data'][0]),float(radar.longitude['data'][0])
+    if isinstance(site, str):
+        try:
+            return RADAR_SITES[site.upper()]
+        except KeyError:
+            raise ValueError('Sitio desconocido: %s. Los sitios disponibles son %s'
+                             % (site, list(RADAR_SITES)))
+    return float(site[0]),float(site[1])
+
 
-    import pyproj
+
+def lat_lon_to_range_azimuth(lat, lon, radar=None, site='RMA1'):
+    """
+    Funcion para calcular el rango y el azimuth de uno o muchos puntos con coordenadas
+    lat y lon teniendo como referencia la ubicacion del radar. El radar se toma del
+    objeto radar si se indica o, si no, del registro RADAR_SITES (por defecto RMA1).
+    Todos los puntos se calculan en una sola llamada a la geodesica WGS84 del modulo.
+    Parameters:
+               lat (float o array): Latitud en grados decimales.
+               lon (float o array): Longitud en grados decimales.
+               radar (radar obj): Objeto radar del que se toma la ubicacion. Default None.
+               site (str o tuple): Nombre del sitio en RADAR_SITES ('RMA1', ..., 'RMA11') o
+                                   tupla (lat, lon) del radar. Default 'RMA1'.
+    Return:
+            distance (float o array): Distancia al radar en km (rango).
+            azimuth (float o array): Azimuth del punto ingresado en grados. Medido en sentido
+                                     horario con el 0 en el norte geográfico.
+    """
 
     # Latitud y Longitud del radar meteorológico
-    radar_lat = -31.4412824015
-    radar_lon = -64.1919061484
-    
+    radar_lat,radar_lon = _radar_site(radar, site)
+
+    lat_arr,lon_arr = np.broadcast_arrays(np.asarray(lat, dtype=float), np.asarray(lon, dtype=float))
+
     # Calculo de la distancia y azimuth del segmento radar-punto
-    geodesic = pyproj.Geod(ellps='WGS84')
-    fwd_azimuth, back_azimuth, distance = geodesic.inv(radar_lon,
-                                                       radar_lat,
-                                                       lon,
-                                                       lat)
+    fwd_azimuth, back_azimuth, distance = _get_geod().inv(np.full(lon_arr.shape, radar_lon),
+                                                          np.full(lat_arr.shape, radar_lat),
+                                                          lon_arr,
+                                                          lat_arr)
 
     # Distancia radar-punto en kilometros
-    distance = distance/1000.
-    
+    distance = np.asarray(distance)/1000.
+
     # Azimuth del segmento radar-punto. 0° en dirección
     # norte y aumentando en sentido horario
-    if 0 <= fwd_azimuth <= 180:
-        azimuth = fwd_azimuth
-    elif -180 <= fwd_azimuth < 0:
-        azimuth = 180 + back_azimuth
+    azimuth = np.asarray(fwd_azimuth) % 360.
 
+    if lat_arr.ndim == 0:
+        return float(distance),float(azimuth)
     return distance,azimuth
 
 
@@ -539,3 +2815,531 @@ def calculate_R_from_Z_ZDR_R(a,b,c,Z,ZDR):
     """
     return a*(Z**b)*(ZDR**c)
 
+
+
+
+def rain_rate_volume(radar,
+                     coefficients,
+                     dbz_field='DBZH',
+                     zdr_field=None,
+                     dbz_thresholds=None,
+                     out=None,
+                     invalid=None):
+    """
+    Funcion para calcular la tasa de precipitacion R sobre todo el volumen (o PPI) en una
+    sola pasada por barrido, directamente a partir de los valores en dB. Equivale a
+    db_to_linear seguido de calculate_R_from_Z_R (o calculate_R_from_Z_ZDR_R) pero sin
+    arrays temporarios del tamaño del volumen, usando que:
+
+            Z-R:      R = (Z/a)**(1/b)      = exp( ln(10)/(10*b)*dBZ - ln(a)/b )
+            Z-ZDR-R:  R = a*Z**b*ZDR**c     = exp( ln(a) + b*ln(10)/10*dBZ + c*ln(10)/10*ZDR[dB] )
+
+    El calculo se hace en float32, barrido por barrido, escribiendo en out. La memoria
+    pico queda cerca del tamaño de un campo (el resultado y su mascara).
+    Los coeficientes pueden ser unicos, uno por barrido, o por tramos de reflectividad.
+    Parameters:
+            radar (radar obj): objeto radar
+            coefficients (tuple o list): (a, b) para Z-R o (a, b, c) para Z-ZDR-R. Puede ser
+                                         una lista con una tupla por barrido o, si se indica
+                                         dbz_thresholds, una tupla por tramo.
+            dbz_field (str): Nombre del campo de reflectividad en dBZ. Default 'DBZH'.
+            zdr_field (str): Nombre del campo ZDR en dB. None para usar Z-R. Default None.
+            dbz_thresholds (list): Limites crecientes de dBZ entre tramos. El tramo k se usa
+                                   para thresholds[k-1] <= dBZ < thresholds[k]. Default None.
+            out (array): Array float32 (nrays, ngates) donde escribir el resultado. None para
+                         crear uno nuevo. Default None.
+            invalid (array bool): Mascara adicional (por ejemplo de qc_mask) con True en los
+                                  gates a descartar. Default None.
+
+    Returns:
+            R (masked array): Tasa de precipitacion en mm/h. Sus datos son out y la mascara
+                              es una copia que combina la de dBZ, la de ZDR e invalid.
+    """
+    shape = (radar.nrays, radar.ngates)
+    if out is None:
+        out = np.empty(shape, dtype=np.float32)
+    elif out.shape != shape:
+        raise ValueError('out debe tener dimensiones %s' % (shape,))
+
+    dbz = radar.fields[dbz_field]['data']
+    zdr = radar.fields[zdr_field]['data'] if zdr_field is not None else None
+
+    # Mascara del resultado: se combina una sola vez para todo el volumen. Siempre es
+    # una copia para que enmascarar el resultado no modifique la mascara del campo DBZH
+    mask = np.ma.getmaskarray(dbz).copy()
+    if zdr is not None:
+        mask |= np.ma.getmaskarray(zdr)
+    if invalid is not None:
+        mask |= invalid
+
+    # Coeficientes de los exponentes: (dBZ, constante, ZDR) por barrido o por tramo
+    n_coefs = 3 if zdr is not None else 2
+    if dbz_thresholds is not None:
+        thresholds = np.asarray(dbz_thresholds, dtype=np.float32)
+        pieces = np.array([_rain_rate_exponents(coefs, n_coefs) for coefs in coefficients],
+                          dtype=np.float32)
+        if len(pieces) != len(thresholds) + 1:
+            raise ValueError('Se necesita una tupla de coeficientes por tramo (len(dbz_thresholds)+1)')
+    elif np.ndim(coefficients[0]) == 0:
+        sweep_exponents = [_rain_rate_exponents(coefficients, n_coefs)]*radar.nsweeps
+    else:
+        if len(coefficients) != radar.nsweeps:
+            raise ValueError('Se necesita una tupla de coeficientes por barrido')
+        sweep_exponents = [_rain_rate_exponents(coefs, n_coefs) for coefs in coefficients]
+
+    dbz_data = np.ma.getdata(dbz)
+    zdr_data = np.ma.getdata(zdr) if zdr is not None else None
+
+    _count('gates_touched', out.size)
+    with _stage('rain_rate'), np.errstate(over='ignore', invalid='ignore'):
+        for sweep in range(radar.nsweeps):
+            sl = slice(int(radar.sweep_start_ray_index['data'][sweep]),
+                       int(radar.sweep_end_ray_index['data'][sweep]) + 1)
+            chunk = out[sl]
+
+            if dbz_thresholds is None:
+                k_dbz,k_const,k_zdr = sweep_exponents[sweep]
+            else:
+                # Coeficientes de cada gate segun el tramo de dBZ al que pertenece
+                piece = np.searchsorted(thresholds, dbz_data[sl], side='right')
+                k_dbz,k_const,k_zdr = pieces[piece,0],pieces[piece,1],pieces[piece,2]
+
+            # Exponente acumulado en out (sin temporarios del tamaño del volumen)
+            np.multiply(dbz_data[sl], k_dbz, out=chunk, casting='unsafe')
+            chunk += k_const
+            if zdr_data is not None:
+                chunk += np.multiply(zdr_data[sl], k_zdr, dtype=np.float32)
+            np.exp(chunk, out=chunk)
+
+            # Los gates enmascarados no tienen un valor fisico
+            np.copyto(chunk, 0, where=mask[sl])
+
+    return np.ma.masked_array(out, mask=mask, copy=False)
+
+
+
+def _rain_rate_exponents(coefs, n_coefs):
+    """
+    Coeficientes del exponente de rain_rate_volume (k_dbz, k_const, k_zdr) para una tupla
+    (a, b) de Z-R o (a, b, c) de Z-ZDR-R.
+    """
+    if len(coefs) != n_coefs:
+        raise ValueError('Se esperaban %d coeficientes y se recibieron %d' % (n_coefs, len(coefs)))
+    ln10 = math.log(10)
+    if n_coefs == 2:
+        a,b = coefs
+        return ln10/(10*b), -math.log(a)/b, 0.
+    a,b,c = coefs
+    return b*ln10/10, math.log(a), c*ln10/10
+
+
+
+def radar_grid_lat_lon(radar=None, site='RMA1', resolution=1000., max_range=None):
+    """
+    Funcion para generar una grilla regular (en la proyeccion azimutal equidistante
+    centrada en el radar) que cubre el alcance del radar, para usar con
+    build_grid_weights.
+    Parameters:
+            radar (radar obj): Objeto radar del que se toman la ubicacion y el alcance.
+                               Default None.
+            site (str o tuple): Sitio en RADAR_SITES o tupla (lat, lon) si no se indica
+                                radar. Default 'RMA1'.
+            resolution (float): Separacion entre celdas en metros. Default 1000.
+            max_range (float): Semiancho de la grilla en metros. None usa el ultimo gate
+                               del radar (o 120 km si no se indica radar). Default None.
+
+    Returns:
+            lons (array): Longitudes de los centros de las celdas (filas de sur a norte).
+            lats (array): Latitudes de los centros de las celdas (filas de sur a norte).
+    """
+    radar_lat,radar_lon = _radar_site(radar, site)
+    if max_range is None:
+        max_range = float(radar.range['data'][-1]) if radar is not None else 120000.
+
+    n = int(max_range // resolution)
+    axis = np.arange(-n, n + 1)*float(resolution)
+    x,y = np.meshgrid(axis, axis)
+    lons,lats = pyart.core.cartesian_to_geographic_aeqd(x, y, radar_lon, radar_lat)
+    return lons,lats
+
+
+
+class RadarGridWeights:
+    """
+    Pesos de interpolacion polar -> grilla de una geometria de escaneo, como una matriz
+    dispersa (scipy.sparse CSR). Cada fila es una celda de la grilla (por barrido) y cada
+    columna un gate del volumen (rayo*ngates + gate), de modo que aplicar los pesos a un
+    volumen es un solo producto matriz dispersa por vector. Se construyen con
+    build_grid_weights y se guardan en disco con save/load.
+
+    Parameters:
+              matrix (sparse matrix): Pesos (barridos*celdas, nrays*ngates).
+              grid_shape (tuple): Dimensiones de la grilla.
+              volume_shape (tuple): Dimensiones (nrays, ngates) del volumen.
+              sweeps (list): Barridos de las filas, de menor a mayor elevacion.
+              method (str): 'nearest' o 'idw'.
+              fingerprint (str): Huella de la geometria (geometry_fingerprint).
+    """
+
+    def __init__(self, matrix, grid_shape, volume_shape, sweeps, method, fingerprint):
+        self.matrix = matrix.tocsr()
+        self.grid_shape = tuple(int(n) for n in grid_shape)
+        self.volume_shape = tuple(int(n) for n in volume_shape)
+        self.sweeps = [int(sweep) for sweep in sweeps]
+        self.method = str(method)
+        self.fingerprint = str(fingerprint)
+
+    def matches(self, radar):
+        """True si el volumen tiene la misma geometria con la que se calcularon los pesos."""
+        return geometry_fingerprint(radar) == self.fingerprint
+
+    def apply(self, data):
+        """
+        Interpola un campo del volumen a la grilla. Los gates enmascarados (o NaN) no
+        se usan: el resultado se normaliza con la suma de los pesos de los gates
+        validos. Con varios barridos, cada celda toma el valor del barrido valido de
+        menor elevacion.
+
+        Parameters:
+                  data (array o masked array): Campo (nrays, ngates) del volumen, por
+                                  ejemplo radar.fields['DBZH']['data'] o la salida de
+                                  rain_rate_volume.
+
+        Returns:
+                  grid (masked array): Campo en la grilla (grid_shape). Las celdas sin
+                                       gates validos quedan enmascaradas.
+        """
+        if np.shape(data) != self.volume_shape:
+            raise ValueError('Las dimensiones del campo %s no coinciden con las de los pesos %s'
+                             % (np.shape(data), self.volume_shape))
+        values = np.ma.getdata(data).reshape(-1)
+        valid = ~np.ma.getmaskarray(data).reshape(-1) & np.isfinite(values)
+
+        with _stage('gridding'):
+            # Numerador y suma de pesos validos en un solo producto (dos columnas)
+            stacked = np.empty((values.size, 2), dtype=np.float64)
+            stacked[:,0] = np.where(valid, values, 0.)
+            stacked[:,1] = valid
+            product = self.matrix @ stacked
+
+            n_cells = int(np.prod(self.grid_shape))
+            weight = product[:,1].reshape(len(self.sweeps), n_cells)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                grid = product[:,0].reshape(len(self.sweeps), n_cells)/weight
+            grid_valid = weight > 0
+
+            # Barrido valido de menor elevacion de cada celda
+            lowest = np.argmax(grid_valid, axis=0)
+            cells = np.arange(n_cells)
+            grid = grid[lowest,cells]
+            grid_valid = grid_valid[lowest,cells]
+
+        return np.ma.masked_array(grid.reshape(self.grid_shape),
+                                  mask=~grid_valid.reshape(self.grid_shape))
+
+    def save(self, path):
+        """Guarda los pesos en un archivo .npz."""
+        matrix = self.matrix
+        np.savez(path,
+                 data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                 matrix_shape=np.asarray(matrix.shape),
+                 grid_shape=np.asarray(self.grid_shape),
+                 volume_shape=np.asarray(self.volume_shape),
+                 sweeps=np.asarray(self.sweeps),
+                 method=np.asarray(self.method),
+                 fingerprint=np.asarray(self.fingerprint))
+
+    @classmethod
+    def load(cls, path):
+        """Lee los pesos guardados con save."""
+        from scipy import sparse
+
+        with np.load(path) as npz:
+            matrix = sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']),
+                                       shape=tuple(npz['matrix_shape']))
+            return cls(matrix, npz['grid_shape'], npz['volume_shape'], npz['sweeps'],
+                       npz['method'][()], npz['fingerprint'][()])
+
+
+
+def build_grid_weights(radar,
+                       longitudes,
+                       latitudes,
+                       method='nearest',
+                       sweeps=0,
+                       window=3,
+                       power=2.,
+                       cache_dir=None):
+    """
+    Funcion para calcular los pesos de interpolacion de un volumen de radar a una grilla
+    (ver radar_grid_lat_lon). Los pesos dependen solo de la geometria del escaneo, asi que
+    se calculan una vez y se aplican a cada volumen nuevo con RadarGridWeights.apply:
+
+        weights = build_grid_weights(radar, lons, lats, cache_dir='pesos')
+        R = weights.apply(rain_rate_volume(radar, (300, 1.4)))
+
+    El gate mas cercano a cada celda se obtiene con get_nearest_gate_azimuth_batch y los
+    vecinos para 'idw' con la misma ventana NxN de radar_variable_window_lat_lon_array.
+    Las celdas mas alla del ultimo gate no tienen pesos.
+    Requiere scipy.
+    Parameters:
+            radar (radar obj): Objeto radar con la geometria de escaneo.
+            longitudes (array): Longitudes de los centros de las celdas.
+            latitudes (array): Latitudes de los centros de las celdas.
+            method (str): 'nearest' (gate mas cercano) o 'idw' (inverso de la distancia a
+                          los gates de la ventana NxN). Default 'nearest'.
+            sweeps (int o list): Barrido o lista de barridos. Con varios barridos cada
+                                 celda toma el barrido valido de menor elevacion.
+                                 Default 0.
+            window (int): Tamaño N (impar) de la ventana de vecinos para 'idw'. Default 3.
+            power (float): Exponente del inverso de la distancia para 'idw'. Default 2.
+            cache_dir (str): Directorio donde guardar/leer los pesos, con la huella de la
+                             geometria y de la grilla como nombre. Default None.
+
+    Returns:
+            weights (RadarGridWeights): Pesos de interpolacion.
+    """
+    from scipy import sparse
+
+    if method not in ('nearest', 'idw'):
+        raise ValueError("method debe ser 'nearest' o 'idw'")
+    _check_window(window)
+
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    grid_shape = longitudes.shape
+    lons = longitudes.reshape(-1)
+    lats = latitudes.reshape(-1)
+
+    # Barridos de menor a mayor elevacion
+    sweeps = sorted((int(sweep) for sweep in np.atleast_1d(sweeps)),
+                    key=lambda sweep: float(radar.fixed_angle['data'][sweep]))
+
+    fingerprint = geometry_fingerprint(radar)
+    path = None
+    if cache_dir is not None:
+        h = hashlib.sha1(lons.tobytes() + b'|' + lats.tobytes())
+        h.update(repr((grid_shape, method, sweeps, window, float(power))).encode())
+        path = os.path.join(cache_dir, '%s_%s.npz' % (fingerprint, h.hexdigest()))
+        if os.path.exists(path):
+            return RadarGridWeights.load(path)
+
+    x,y = pyart.core.geographic_to_cartesian_aeqd(lons, lats,
+                                                  radar.longitude['data'][0],
+                                                  radar.latitude['data'][0])
+    x = np.ravel(x)
+    y = np.ravel(y)
+    r = np.hypot(x, y)
+    n_cells = lons.size
+    half = window // 2 if method == 'idw' else 0
+
+    rows,cols,vals = [],[],[]
+    for k,sweep in enumerate(sweeps):
+        gates,rays = get_nearest_gate_azimuth_batch(radar, lons, lats, sweep)
+        gate_distance = _gate_ground_distance(radar, sweep)
+        inside = r <= _max_ground_range(radar, sweep)
+
+        # Vecinos (celdas, N*N); para 'nearest' la ventana es de 1x1
+        ray_idx,gate_idx = _window_indices(radar, gates, rays, 2*half + 1)
+        ray_idx = ray_idx.reshape(n_cells, -1)
+        gate_idx = gate_idx.reshape(n_cells, -1)
+
+        if method == 'nearest':
+            weights = np.ones(gate_idx.shape)
+        else:
+            azimuth = np.radians(np.asarray(radar.azimuth['data'], dtype=np.float64)[ray_idx])
+            distance = np.hypot(gate_distance[gate_idx]*np.sin(azimuth) - x[:,None],
+                                gate_distance[gate_idx]*np.cos(azimuth) - y[:,None])
+            weights = 1./np.maximum(distance, 1.)**power
+            # Los gates repetidos al recortar el rango se cuentan una sola vez
+            unclipped = gates[:,None,None] + (half - np.arange(window))[None,:,None]
+            unclipped = np.broadcast_to(unclipped, (n_cells, window, window)).reshape(n_cells, -1)
+            weights[(unclipped < 0) | (unclipped >= radar.ngates)] = 0.
+            weights /= weights.sum(axis=1, keepdims=True)
+        weights[~inside] = 0.
+
+        rows.append(np.broadcast_to((k*n_cells + np.arange(n_cells))[:,None], gate_idx.shape).ravel())
+        cols.append((ray_idx*radar.ngates + gate_idx).ravel())
+        vals.append(weights.ravel())
+
+    matrix = sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                               shape=(len(sweeps)*n_cells, radar.nrays*radar.ngates))
+    matrix.eliminate_zeros()
+
+    result = RadarGridWeights(matrix, grid_shape, (radar.nrays, radar.ngates), sweeps, method,
+                              fingerprint)
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        result.save(path)
+    return result
+
+
+
+class RainfallAccumulator:
+    """
+    Acumulador incremental de precipitacion. Recibe volumenes en orden temporal (la tasa
+    R en mm/h de calculate_R_*, rain_rate_volume o de las ventanas en estaciones) e
+    integra R x Δt entre volumenes consecutivos con la regla del trapecio, usando las
+    fechas reales de los volumenes. Solo se guardan en memoria la tasa del volumen anterior
+    y las sumas de los periodos abiertos (por ejemplo horas o dias).
+    Los intervalos mayores a max_gap se descartan (gap_rule='skip') o se integran solo
+    durante max_gap (gap_rule='cap'). Se puede guardar y restaurar el estado (save/load)
+    para que un proceso reiniciado continue sin releer los volumenes anteriores.
+
+    Parameters:
+              period (str): Periodo de acumulacion con la notacion de pandas ('1h', '1D', ...).
+                            Los limites se toman en la hora del volumen (UTC). Default '1h'.
+              max_gap (timedelta): Maximo intervalo entre volumenes a integrar. Default 20 minutos.
+              gap_rule (str): 'skip' o 'cap'. Default 'skip'.
+    """
+
+    def __init__(self, period='1h', max_gap=timedelta(minutes=20), gap_rule='skip'):
+        if gap_rule not in ('skip', 'cap'):
+            raise ValueError("gap_rule debe ser 'skip' o 'cap'")
+        self.period = period
+        self.max_gap = pd.Timedelta(max_gap)
+        self.gap_rule = gap_rule
+        # 'h' o 'D' sin numero equivalen a '1h' o '1D'
+        self._step = pd.Timedelta(period if period[:1].isdigit() else '1'+period)
+        self._prev_time = None
+        self._prev_rate = None
+        self._prev_valid = None
+        # Inicio de periodo -> [suma en mm, segundos integrados con dato valido]
+        self._periods = OrderedDict()
+
+    @property
+    def last_time(self):
+        """Fecha del ultimo volumen agregado (None si no hay ninguno)."""
+        return None if self._prev_time is None else self._prev_time.to_pydatetime()
+
+    def add(self, fecha, rate):
+        """
+        Agrega un volumen. Los gates/estaciones enmascarados no suman precipitacion ni
+        tiempo de cobertura.
+
+        Parameters:
+                  fecha (datetime obj): Fecha y hora del volumen.
+                  rate (array o masked array): Tasa de precipitacion en mm/h. Todas las
+                                               llamadas deben tener la misma forma.
+        """
+        fecha = pd.Timestamp(fecha)
+        rate = np.ma.asarray(rate)
+        valid = ~np.ma.getmaskarray(rate)
+        rate = np.ma.filled(rate.astype(np.float32), 0)
+
+        if self._prev_time is not None:
+            if fecha <= self._prev_time:
+                raise ValueError('Los volumenes deben agregarse en orden temporal')
+            if rate.shape != self._prev_rate.shape:
+                raise ValueError('La forma de rate cambio entre volumenes')
+
+            t0 = self._prev_time
+            if fecha - t0 > self.max_gap:
+                t0 = None if self.gap_rule == 'skip' else fecha - self.max_gap
+
+            if t0 is not None:
+                # Trapecio; si un extremo no es valido se usa el otro
+                both = valid & self._prev_valid
+                mean_rate = np.where(both, 0.5*(rate + self._prev_rate),
+                                     np.where(valid, rate, self._prev_rate))
+                covered = valid | self._prev_valid
+                self._integrate(t0, fecha, mean_rate, covered)
+
+        self._prev_time = fecha
+        self._prev_rate = rate
+        self._prev_valid = valid
+
+    def add_radar(self, radar, coefficients, **kwargs):
+        """
+        Calcula R sobre el volumen con rain_rate_volume y lo agrega con la fecha de
+        radar.time['units']. kwargs se pasan a rain_rate_volume.
+        """
+        self.add(radar_datetime(radar), rain_rate_volume(radar, coefficients, **kwargs))
+
+    def _integrate(self, t0, t1, mean_rate, covered):
+        # Reparto el intervalo [t0, t1] entre los periodos que atraviesa
+        start = t0
+        while start < t1:
+            period_start = start.floor(self._step)
+            end = min(period_start + self._step, t1)
+            seconds = (end - start).total_seconds()
+            if period_start not in self._periods:
+                self._periods[period_start] = [np.zeros(mean_rate.shape, dtype=np.float64),
+                                               np.zeros(mean_rate.shape, dtype=np.float64)]
+            total,coverage = self._periods[period_start]
+            total += mean_rate*(seconds/3600.)
+            coverage += covered*seconds
+            start = end
+
+    def _result(self, period_start):
+        total,coverage = self._periods[period_start]
+        fraction = coverage/self._step.total_seconds()
+        return (period_start.to_pydatetime(),
+                np.ma.masked_array(total, mask=coverage == 0),
+                fraction)
+
+    def pop_completed(self):
+        """
+        Devuelve y quita de memoria los periodos ya cerrados (los que terminan antes del
+        ultimo volumen agregado).
+
+        Returns:
+                  completed (list): Lista de tuplas (inicio del periodo, precipitacion en mm
+                                    (masked array, enmascarada sin cobertura), fraccion del
+                                    periodo con dato valido).
+        """
+        completed = []
+        for period_start in list(self._periods):
+            if period_start + self._step <= self._prev_time:
+                completed.append(self._result(period_start))
+                del self._periods[period_start]
+        return completed
+
+    def totals(self):
+        """
+        Devuelve, sin quitarlos, todos los periodos en memoria (incluido el abierto) con el
+        mismo formato que pop_completed.
+        """
+        return [self._result(period_start) for period_start in self._periods]
+
+    def save(self, path):
+        """
+        Guarda el estado en un archivo .npz. La escritura es atomica (archivo temporal y
+        reemplazo) para que un corte no deje un checkpoint corrupto.
+        """
+        meta = {'period': self.period,
+                'max_gap_seconds': self.max_gap.total_seconds(),
+                'gap_rule': self.gap_rule,
+                'prev_time': None if self._prev_time is None else self._prev_time.isoformat(),
+                'periods': [p.isoformat() for p in self._periods]}
+        arrays = {'meta': np.array(json.dumps(meta))}
+        if self._prev_time is not None:
+            arrays['prev_rate'] = self._prev_rate
+            arrays['prev_valid'] = self._prev_valid
+        for k,(total,coverage) in enumerate(self._periods.values()):
+            arrays['total_%d' % k] = total
+            arrays['coverage_%d' % k] = coverage
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Restaura un acumulador guardado con save.
+        """
+        with np.load(path) as npz:
+            meta = json.loads(str(npz['meta']))
+            acc = cls(period=meta['period'],
+                      max_gap=timedelta(seconds=meta['max_gap_seconds']),
+                      gap_rule=meta['gap_rule'])
+            if meta['prev_time'] is not None:
+                acc._prev_time = pd.Timestamp(meta['prev_time'])
+                acc._prev_rate = npz['prev_rate']
+                acc._prev_valid = npz['prev_valid']
+            for k,period_start in enumerate(meta['periods']):
+                acc._periods[pd.Timestamp(period_start)] = [npz['total_%d' % k],
+                                                            npz['coverage_%d' % k]]
+        return acc